@@ -0,0 +1,73 @@
+import threading
+
+
+class AcquisitionService:
+    def __init__(self, sensor):
+        """
+        Initialization of the acquisition service of a (connected) Sensor or ProcessSensor.
+        Once started, the device keeps streaming for the whole session: pausing and resuming only close and open
+        the software gate in front of the sensor's buffers, so that no device command is needed at trial boundaries.
+        """
+        self.sensor = sensor
+        self.streaming = False
+        self.recording = False
+        self.lock = threading.Lock()
+
+    def start(self, recording=True):
+        """
+        Starts the device stream (if not already streaming), recording right away unless recording is False.
+
+        :return: boolean (False if the stream could not be started)
+        """
+        with self.lock:
+            if not self.streaming:
+                self.sensor.set_recording(False)
+                try:
+                    started = self.sensor.start_streaming()
+                except Exception as err:
+                    print(err)
+                    started = False
+                if not started:
+                    print("A problem with sensor or command occured while starting the sensor signal.")
+                    return False
+                self.streaming = True
+                print("Started streaming signal...")
+            self.set_recording(recording)
+            return True
+
+    def pause(self):
+        """
+        Stops recording the samples, while the device keeps streaming.
+        """
+        with self.lock:
+            if self.streaming:
+                self.set_recording(False)
+
+    def resume(self):
+        """
+        Records the streamed samples again.
+        """
+        with self.lock:
+            if self.streaming:
+                self.set_recording(True)
+
+    def stop(self):
+        """
+        Stops recording and the device stream.
+        """
+        with self.lock:
+            if self.streaming:
+                self.set_recording(False)
+                self.sensor.stop_streaming()
+                self.streaming = False
+                print("Stopped streaming signal...")
+
+    def set_recording(self, recording):
+        self.sensor.set_recording(recording)
+        self.recording = recording
+
+    def is_streaming(self):
+        return self.streaming
+
+    def is_recording(self):
+        return self.recording
@@ -0,0 +1,126 @@
+import sys
+from collections import deque, namedtuple
+import numpy as np
+from dsp import StreamingDetrender
+
+# Initializations of some static variables:
+BLINK_THRESHOLD = 5 * (10 ** -5) # 0.00005
+BLINK_WINDOW = 100 # samples
+BASELINE_SLICE = (0, 99) # The part of the window the signal level before the blink is averaged over
+DIP_SLICE = (80, 90) # The part of the window where the blink dip is looked for
+REFRACTORY_PERIOD = 10 / 60 # seconds without a new blink after a detected one (used to be 10 frames at 60 FPS)
+DRIFT_WINDOW = 500 # samples the electrode drift is fitted over
+EVENT_HISTORY = 100
+
+BlinkEvent = namedtuple('BlinkEvent', ['timestamp', 'index', 'amplitude'])
+
+
+class BlinkDetector:
+    def __init__(self, threshold=BLINK_THRESHOLD, channel=0, refractory_period=REFRACTORY_PERIOD, sample_freq=250,
+                       drift_window=DRIFT_WINDOW):
+        """
+        Initialization of the streaming blink detector, fed with the samples as they arrive (see Sensor.add_listener).
+        The channel (O1 by default) is detrended on arrival, then for the window of the last BLINK_WINDOW samples ending at
+        every sample, the mean over the dip slice is compared to the mean over the baseline slice, using prefix sums.
+        A blink is detected when the dip goes below the baseline by more than the threshold. The detector is then re-armed
+        only once the amplitude has dropped back below the threshold, and at least refractory_period seconds later,
+        so that every blink gives a single event (its dip stays above the threshold for most of the window).
+        Every blink is emitted as a BlinkEvent (timestamp of the sample, global sample index, dip amplitude) to the listeners.
+        """
+        self.threshold = threshold
+        self.channel = channel
+        self.refractory_samples = int(round(refractory_period * sample_freq))
+        self.detrender = StreamingDetrender(1, drift_window)
+        self.history = np.empty(0) # The last BLINK_WINDOW - 1 detrended samples
+        self.samples_seen = 0
+        self.last_blink_index = None
+        self.above_threshold = False # Whether the amplitude of the last window was above the threshold
+        self.listeners = []
+        self.events = deque(maxlen=EVENT_HISTORY)
+
+    def add_listener(self, listener):
+        """
+        Registers a listener, called as listener(event) with every detected BlinkEvent.
+        """
+        self.listeners.append(listener)
+
+    def on_samples(self, block, timestamps):
+        """
+        Processes a (channels x n) block of new samples and their timestamps.
+
+        :return: list of the BlinkEvents detected in the block
+        """
+        detrended = self.detrender.update(np.asarray(block)[self.channel][None, :])[0]
+        signal = np.concatenate((self.history, detrended))
+        prefix = np.concatenate(([0], np.cumsum(signal)))
+
+        # The windows ending at the new samples (and covered by the signal), given by their last index in signal
+        ends = np.arange(max(self.history.size, BLINK_WINDOW - 1), signal.size)
+        starts = ends - (BLINK_WINDOW - 1)
+        baseline = (prefix[starts + BASELINE_SLICE[1]] - prefix[starts + BASELINE_SLICE[0]]) / (BASELINE_SLICE[1] - BASELINE_SLICE[0])
+        dip = (prefix[starts + DIP_SLICE[1]] - prefix[starts + DIP_SLICE[0]]) / (DIP_SLICE[1] - DIP_SLICE[0])
+        amplitudes = baseline - dip
+
+        # Only the windows where the amplitude rises above the threshold can start a blink
+        above = amplitudes > self.threshold
+        rising = above & ~np.concatenate(([self.above_threshold], above[:-1]))
+        if above.size:
+            self.above_threshold = bool(above[-1])
+
+        events = []
+        first_index = self.samples_seen - self.history.size # Global index of signal[0]
+        for end in ends[rising]:
+            index = first_index + int(end)
+            if self.last_blink_index != None and index - self.last_blink_index < self.refractory_samples:
+                continue
+            self.last_blink_index = index
+            events.append(BlinkEvent(float(timestamps[end - self.history.size]), index, float(amplitudes[end - ends[0]])))
+
+        self.history = signal[-(BLINK_WINDOW - 1):]
+        self.samples_seen += detrended.size
+        for event in events:
+            self.events.append(event)
+            for listener in self.listeners:
+                listener(event)
+        return events
+
+
+if __name__ == "__main__":
+    # Command format is: python3 ./blink_detector.py [seconds of synthetic signal, 600 by default]
+    # Checks the detector against the blinks of a synthetic signal: a single blink must give exactly one event
+    from synthetic_eeg import SyntheticEEG
+    sample_freq, block_size = 250, 25
+
+    def detect(data):
+        detector = BlinkDetector(sample_freq=sample_freq)
+        events = []
+        for start in range(0, data.shape[1], block_size):
+            block = data[:, start:start + block_size]
+            events += detector.on_samples(block, (start + np.arange(block.shape[1])) / sample_freq)
+        return events
+
+    # A single blink, 4 seconds into 8 seconds of signal, from the generator's amplitude to 4 times it
+    # (the larger the blink, the longer its dip stays above the threshold)
+    generator = SyntheticEEG(sample_freq, blink_rate=0, seed=0)
+    background = generator.generate(8 * sample_freq)
+    onset = 4 * sample_freq
+    for scale in (1, 1.5, 2, 3, 4):
+        data = background.copy()
+        data[generator.blink_channels, onset:onset + generator.blink_template.size] += scale * generator.blink_amplitude * generator.blink_template
+        events = detect(data)
+        if len(events) != 1:
+            sys.exit(f"A single blink ({scale} times the synthetic amplitude) gave {len(events)} events")
+        print(f"Single blink ({scale} times the synthetic amplitude): 1 event, {events[0].index - onset} samples after the onset")
+
+    # Many blinks: every event must fall on a different blink
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    generator = SyntheticEEG(sample_freq, seed=1)
+    data = generator.generate(seconds * sample_freq)
+    onsets = np.array(generator.blink_onsets)
+    events = detect(data)
+    # Every event is matched to the last blink that started before it
+    matched = np.searchsorted(onsets, [event.index for event in events], side='right') - 1
+    duplicates = len(matched) - len(np.unique(matched))
+    print(f"{len(onsets)} blinks, {len(events)} events, {len(np.unique(matched[matched >= 0]))} blinks detected, {duplicates} duplicate events")
+    if duplicates:
+        sys.exit("Some blinks gave more than one event")
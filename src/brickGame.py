@@ -3,19 +3,29 @@ import pygame.gfxdraw
 import math
 import numpy as np
 import os
+import sys
 import atexit
+from functools import partial, lru_cache
 
 from matplotlib import pyplot as plt
-from sklearn.linear_model import LinearRegression
 # from scipy.fft import rfft, rfftfreq
 
 from button import Button
 from sensor import Sensor
+from process_sensor import ProcessSensor
+from acquisition import AcquisitionService
+from dsp import detrend, exact_bin_segment, MAINS_FREQ
+from blink_detector import BlinkDetector
+from pipeline import Pipeline, SensorSource, FunctionStage, ssvep_stages
+from scheduler import FrameScheduler
+from frame_timing import FrameTimer, measure_refresh_rate, achievable_flicker_frequencies, flicker_period
+from stimulus import StimulusSchedule, StimulusTarget
+from sensor_backends import ReplayBackend, SyntheticBackend
 from threading import Thread
+from collections import deque
 
 
 # Initializations of some static variables:
-SESSION_LENGTH = 900
 BLINK_THRESHOLD = 5 * (10 ** -5) # 0.00005
 ATTENTION_THRESHOLD = 1 * (10 ** -5)
 
@@ -23,18 +33,47 @@ WIN_WIDTH, WIN_HEIGHT = 800, 700 # !Original height: 800, Original width: 700
 PADDLE_WIDTH, PADDLE_HEIGHT, PADDLE_VEL = 100, 20, 100
 BALL_RADIUS, BALL_INITIAL_VEL = 10, 4 # !Original velocity: 4
 MAX_DIFFICULTY, MAX_LIVES = 5, 5
-FPS = 60
+FPS = 60 # The frame rate used when the refresh rate of the display cannot be detected
+RIGHT_FLICKER_FREQ = 20 # Hz, the target frequency of the right flicker (the closest achievable one at the refresh rate is shown)
 SAMPLE_FREQ = 250
+DRIFT_WINDOW = 2 * SAMPLE_FREQ # samples the electrode drift is fitted over
+LOG_CHANNELS = ('occ_1', 'occ_2', 'tmp_1', 'tmp_2') # Log names of the channels: occ. electrodes 1 and 2 (left and right hemisphere), then tmp. electrodes 1 and 2
 
-def reading_task(mySensor: Sensor):
+def detect_refresh_rate():
     """
-    Calls the sensor reading method from the given sensor object.
+    Returns the refresh rate of the display: the one reported by pygame if it can, else the one measured over timed flips,
+    else FPS (if the flips are not synchronized to the refresh).
     """
-    print('Start reading the sensor: ')
-    mySensor.read_sensor_Ts(SESSION_LENGTH)
+    get_current_refresh_rate = getattr(pygame.display, 'get_current_refresh_rate', None)
+    if get_current_refresh_rate != None:
+        refresh_rate = get_current_refresh_rate()
+        if refresh_rate > 0:
+            return refresh_rate
+    refresh_rate = measure_refresh_rate(pygame.display.flip)
+    if refresh_rate != None:
+        return refresh_rate
+    print(f"The refresh rate of the display could not be detected, {FPS} Hz is assumed")
+    return FPS
+
+
+@lru_cache(maxsize=64)
+def get_plot_template(epochs):
+    """
+    Returns the format string of the plot lines ("amp time_point") of a batch of epochs, to fill with (amps, time points).
+    """
+    return "".join(f"{{0[{i}]}} {{1[{i}]}}\n" for i in range(epochs))
+
+
+@lru_cache(maxsize=256)
+def get_data_template(lengths):
+    """
+    Returns the format string of the data lines of consecutive segments of the given lengths, to fill with their samples.
+    """
+    return "".join("{} " * length + "\n" for length in lengths)
+
 
 class Game:
-    def __init__(self):
+    def __init__(self, backend_factory=None, out_of_process=False):
         pygame.init()
         
         # Set the working directory to directory of the file:
@@ -42,7 +81,13 @@ class Game:
         dname = os.path.dirname(abspath)
         os.chdir(dname)
 
-        self.EEGSensor = Sensor()
+        # Lost samples are interpolated, so that the flicker periods cut from the stream stay in phase
+        if out_of_process:
+            # The acquisition runs in its own process, so that frame jank and sample loss do not affect each other
+            self.EEGSensor = ProcessSensor(backend_factory, gap_fill='linear')
+        else:
+            self.EEGSensor = Sensor(backend_factory() if backend_factory != None else None, gap_fill='linear')
+        self.acquisition = AcquisitionService(self.EEGSensor)
         self.button_background_img = pygame.image.load('../images/UI_Flat_Frame_02_Horizontal.png')
         self.WIDTH, self.HEIGHT = WIN_WIDTH, WIN_HEIGHT
         self.win = pygame.display.set_mode((self.WIDTH, self.HEIGHT))
@@ -53,7 +98,9 @@ class Game:
         self.connection_flag = False
         self.difficulty = 1
 
-        self.FPS = FPS
+        # The flicker frequencies are planned for the actual refresh rate of the display
+        self.FPS = detect_refresh_rate()
+        print(f"Display refresh rate: {self.FPS:g} Hz")
         self.PADDLE_WIDTH = PADDLE_WIDTH
         self.PADDLE_HEIGHT = PADDLE_HEIGHT
         self.BALL_RADIUS = BALL_RADIUS
@@ -107,35 +154,6 @@ class Game:
                 self.game_occ_2_plot_file.write(f"{y} {self.game_occ_plot_time_counter}\n")
             self.game_occ_plot_time_counter += 1
 
-    def list_overlap_len(self, l1, l2):
-        def list_overlap_len_rec(l1, l2, rel_last_idx):
-            
-            if rel_last_idx <= len(l2) - 1:
-                l1_slice = l1[-(rel_last_idx + 1):]
-                l2_slice = l2[:rel_last_idx + 1]
-            elif rel_last_idx <= len(l1) - 1:
-                l1_slice = l1[-(rel_last_idx + 1) : -(rel_last_idx + 1) + len(l2)]
-                l2_slice = l2
-            elif rel_last_idx <= len(l1) + len(l2) - 1:
-                left_spill = rel_last_idx - len(l1) + 1
-                slice_len = len(l2) - left_spill
-                l1_slice = l1[:slice_len]
-                l2_slice = l2[left_spill:]
-            else:
-                return 0
-            
-            if l1_slice == l2_slice:
-                return len(l1_slice) 
-            else:
-                list_overlap_len_rec(l1, l2, rel_last_idx + 1)
-
-        if len(l1) < len(l2):
-            aux = l1
-            l1 = l2
-            l2 = aux
-            
-        return list_overlap_len_rec(l1,l2,0)
-
     def calculate_steps_needed(self, paddle, x_pred):
         """
         Calculates the amount of steps needed (integer) for the paddle to reach to the location that was predicted for the ball to get to at the bottom of the game window.
@@ -378,7 +396,7 @@ class Game:
 
 
     class FlickerWindow:
-        def __init__(self, flicker_on=True,
+        def __init__(self, refresh_rate=FPS, flicker_on=True,
                            period=2,          flicker_on_period=None,
                            left_period=None,  left_flicker_on_period=None,
                            right_period=None, right_flicker_on_period=None):
@@ -436,9 +454,10 @@ class Game:
 
             # i. Basic test
             self.basic_countdown_secs = 5
-            self.basic_countdown_fps = FPS * self.basic_countdown_secs
+            self.refresh_rate = refresh_rate
+            self.basic_countdown_fps = int(round(self.refresh_rate * self.basic_countdown_secs))
             self.basic_test_period_secs = 60 * 5 # 5 mins
-            self.basic_test_period_fps = FPS * self.basic_test_period_secs
+            self.basic_test_period_fps = int(round(self.refresh_rate * self.basic_test_period_secs))
 
             self.basic_flicker = flicker_on
             
@@ -452,15 +471,13 @@ class Game:
                     self.left_flicker = True
                     self.left_sided_flicker = True
                     self.left_period = left_period
-                    self.left_flicker_on_period = left_flicker_on_period
-                    self.left_flicker_count = 1
+                    self.left_flicker_on_period = left_flicker_on_period or left_period // 2
 
                 if right_period:
                     self.right_flicker = True
                     self.right_sided_flicker = True
                     self.right_period = right_period
-                    self.right_flicker_on_period = right_flicker_on_period
-                    self.right_flicker_count = 1
+                    self.right_flicker_on_period = right_flicker_on_period or right_period // 2
             else:
                 self.central_flicker = True
                 self.period = period
@@ -468,7 +485,19 @@ class Game:
                     self.flicker_on_period = flicker_on_period
                 else:
                     self.flicker_on_period = self.period // 2
-                self.flicker_count = 1
+
+            # The colour of every flickering patch at every frame is looked up in the precomputed stimulus tables
+            #   (square waves whose first flicker_on_period frames of each period show the background colour)
+            stimulus_targets = dict()
+            if self.central_flicker:
+                stimulus_targets['center'] = StimulusTarget(self.refresh_rate / self.period, duty=self.flicker_on_period / self.period)
+            if self.left_flicker:
+                stimulus_targets['left'] = StimulusTarget(self.refresh_rate / self.left_period, duty=self.left_flicker_on_period / self.left_period)
+            if self.right_flicker:
+                stimulus_targets['right'] = StimulusTarget(self.refresh_rate / self.right_period, duty=self.right_flicker_on_period / self.right_period)
+            self.stimulus = StimulusSchedule(self.refresh_rate, stimulus_targets,
+                                             tuple(pygame.Color(self.FLICKER_TEST_COLOR_BG))[:3], tuple(pygame.Color(self.FLICKER_TEST_COLOR_PULSE))[:3])
+            self.stimulus_frame = 0 # Index of the next flicker frame
 
             self.basic_patch_width = 120
             self.basic_patch_height = 120
@@ -477,9 +506,9 @@ class Game:
 
             # ii. Complete test
             self.countdown_secs = 1
-            self.countdown_fps = FPS * self.countdown_secs
+            self.countdown_fps = int(round(self.refresh_rate * self.countdown_secs))
             self.single_test_period_secs = 2
-            self.single_test_period_fps = FPS * self.single_test_period_secs
+            self.single_test_period_fps = int(round(self.refresh_rate * self.single_test_period_secs))
 
             # Instruction text fonts
             self.FLICKER_FONT = pygame.font.SysFont("calibri", 30)
@@ -495,6 +524,18 @@ class Game:
             os.makedirs(os.path.dirname(flicker_log_file_name), exist_ok=True)
             self.flicker_log_file = open(flicker_log_file_name, 'w')
 
+            ssvep_power_file_name = "../plots/ssvep_power.txt"
+            os.makedirs(os.path.dirname(ssvep_power_file_name), exist_ok=True)
+            self.ssvep_power_file = open(ssvep_power_file_name, 'w')
+            self.ssvep_power_time_point = 0
+
+            # Timing of the frames of the stimulus (the flicker frequency is only right if no frame is missed)
+            self.frame_timer = FrameTimer(self.refresh_rate)
+
+            spectrogram_file_name = "../plots/spectrogram.txt"
+            self.spectrogram_file = open(spectrogram_file_name, 'w')
+            self.spectrogram_time_point = 0
+
             self.test_no = 0
             self.no_of_tests = 15
             self.has_signaled_flicker_start = False
@@ -505,139 +546,25 @@ class Game:
             self.average_incorrect_activations_percentage = 0
             self.average_indet_activations_percentage = 0
 
-            # Logging
-            if self.central_flicker or not(self.basic_flicker):
-                if self.central_flicker:
-                    occ_1_plot_file_name = "../plots/occ_1_basic_flicker.txt"
-                    occ_2_plot_file_name = "../plots/occ_2_basic_flicker.txt"
-                    occ_1_data_file_name = "../plots/occ_1_basic_flicker_data.txt"
-                    occ_2_data_file_name = "../plots/occ_2_basic_flicker_data.txt"
-                    
-                    tmp_1_plot_file_name = "../plots/tmp_1_basic_flicker.txt"
-                    tmp_2_plot_file_name = "../plots/tmp_2_basic_flicker.txt"
-                    tmp_1_data_file_name = "../plots/tmp_1_basic_flicker_data.txt"
-                    tmp_2_data_file_name = "../plots/tmp_2_basic_flicker_data.txt"
-                else:
-                    occ_1_plot_file_name = "../plots/occ_1_basic_no_flicker.txt"
-                    occ_2_plot_file_name = "../plots/occ_2_basic_no_flicker.txt"
-                    occ_1_data_file_name = "../plots/occ_1_basic_no_flicker_data.txt"
-                    occ_2_data_file_name = "../plots/occ_2_basic_no_flicker_data.txt"
-                    
-                    tmp_1_plot_file_name = "../plots/tmp_1_basic_no_flicker.txt"
-                    tmp_2_plot_file_name = "../plots/tmp_2_basic_no_flicker.txt"
-                    tmp_1_data_file_name = "../plots/tmp_1_basic_no_flicker_data.txt"
-                    tmp_2_data_file_name = "../plots/tmp_2_basic_no_flicker_data.txt"
-
-                os.makedirs(os.path.dirname(occ_1_plot_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(occ_2_plot_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(occ_1_data_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(occ_2_data_file_name), exist_ok=True)
-
-                os.makedirs(os.path.dirname(tmp_1_plot_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(tmp_2_plot_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(tmp_1_data_file_name), exist_ok=True)
-                os.makedirs(os.path.dirname(tmp_2_data_file_name), exist_ok=True)
-
-                self.occ_1_plot_file = open(occ_1_plot_file_name, 'w')
-                self.occ_2_plot_file = open(occ_2_plot_file_name, 'w')
-                self.occ_1_data_file = open(occ_1_data_file_name, 'w')
-                self.occ_2_data_file = open(occ_2_data_file_name, 'w')
-                
-                self.tmp_1_plot_file = open(tmp_1_plot_file_name, 'w')
-                self.tmp_2_plot_file = open(tmp_2_plot_file_name, 'w')
-                self.tmp_1_data_file = open(tmp_1_data_file_name, 'w')
-                self.tmp_2_data_file = open(tmp_2_data_file_name, 'w')
-
-                self.occ_1_plot_time_point = 0
-                self.occ_2_plot_time_point = 0
-                self.tmp_1_plot_time_point = 0
-                self.tmp_2_plot_time_point = 0
-            
-            else:
-                if self.right_flicker:
-                    occ_1_left_plot_file_name = "../plots/occ_1_left_basic_flicker.txt"
-                    occ_2_left_plot_file_name = "../plots/occ_2_left_basic_flicker.txt"
-                    occ_1_left_data_file_name = "../plots/occ_1_left_basic_flicker_data.txt"
-                    occ_2_left_data_file_name = "../plots/occ_2_left_basic_flicker_data.txt"
-                    
-                    tmp_1_left_plot_file_name = "../plots/tmp_1_left_basic_flicker.txt"
-                    tmp_2_left_plot_file_name = "../plots/tmp_2_left_basic_flicker.txt"
-                    tmp_1_left_data_file_name = "../plots/tmp_1_left_basic_flicker_data.txt"
-                    tmp_2_left_data_file_name = "../plots/tmp_2_left_basic_flicker_data.txt"
-
-                    os.makedirs(os.path.dirname(occ_1_left_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_2_left_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_1_left_data_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_2_left_data_file_name), exist_ok=True)
-                    
-                    os.makedirs(os.path.dirname(tmp_1_left_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_2_left_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_1_left_data_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_2_left_data_file_name), exist_ok=True)
-
-                    self.occ_1_left_plot_file = open(occ_1_left_plot_file_name, 'w')
-                    self.occ_2_left_plot_file = open(occ_2_left_plot_file_name, 'w')
-                    self.occ_1_left_data_file = open(occ_1_left_data_file_name, 'w')
-                    self.occ_2_left_data_file = open(occ_2_left_data_file_name, 'w')
-                    
-                    self.tmp_1_left_plot_file = open(tmp_1_left_plot_file_name, 'w')
-                    self.tmp_2_left_plot_file = open(tmp_2_left_plot_file_name, 'w')
-                    self.tmp_1_left_data_file = open(tmp_1_left_data_file_name, 'w')
-                    self.tmp_2_left_data_file = open(tmp_2_left_data_file_name, 'w')
-
-                    self.occ_1_left_plot_time_point = 0
-                    self.occ_2_left_plot_time_point = 0
-                    
-                    self.tmp_1_left_plot_time_point = 0
-                    self.tmp_2_left_plot_time_point = 0
-                
-                if self.left_flicker:
-                    occ_2_right_plot_file_name = "../plots/occ_2_right_basic_flicker.txt"
-                    occ_1_right_plot_file_name = "../plots/occ_1_right_basic_flicker.txt"
-                    occ_2_right_data_file_name = "../plots/occ_2_right_basic_flicker_data.txt"
-                    occ_1_right_data_file_name = "../plots/occ_1_right_basic_flicker_data.txt"
-
-                    tmp_2_right_plot_file_name = "../plots/tmp_2_right_basic_flicker.txt"
-                    tmp_1_right_plot_file_name = "../plots/tmp_1_right_basic_flicker.txt"
-                    tmp_2_right_data_file_name = "../plots/tmp_2_right_basic_flicker_data.txt"
-                    tmp_1_right_data_file_name = "../plots/tmp_1_right_basic_flicker_data.txt"
-
-                    os.makedirs(os.path.dirname(occ_2_right_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_1_right_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_2_right_data_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(occ_1_right_data_file_name), exist_ok=True)
-
-                    os.makedirs(os.path.dirname(tmp_2_right_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_1_right_plot_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_2_right_data_file_name), exist_ok=True)
-                    os.makedirs(os.path.dirname(tmp_1_right_data_file_name), exist_ok=True)
-
-                    self.occ_2_right_plot_file = open(occ_2_right_plot_file_name, 'w')
-                    self.occ_1_right_plot_file = open(occ_1_right_plot_file_name, 'w')
-                    self.occ_2_right_data_file = open(occ_2_right_data_file_name, 'w')
-                    self.occ_1_right_data_file = open(occ_1_right_data_file_name, 'w')
-
-                    self.tmp_2_right_plot_file = open(tmp_2_right_plot_file_name, 'w')
-                    self.tmp_1_right_plot_file = open(tmp_1_right_plot_file_name, 'w')
-                    self.tmp_2_right_data_file = open(tmp_2_right_data_file_name, 'w')
-                    self.tmp_1_right_data_file = open(tmp_1_right_data_file_name, 'w')
-
-                    self.occ_2_right_plot_time_point = 0
-                    self.occ_1_right_plot_time_point = 0
-                    
-                    self.tmp_2_right_plot_time_point = 0
-                    self.tmp_1_right_plot_time_point = 0
+            # Logging: one plot file (min-max difference of every flicker period) and one data file (raw samples)
+            #   per channel and flicker side, keyed by their log name (e.g. 'occ_1_left')
+            self.log_suffixes = [suffix for (suffix, frequency) in self.get_log_conditions()]
+            self.log_names = [channel + suffix for suffix in self.log_suffixes for channel in LOG_CHANNELS]
+            flicker_kind = 'flicker' if self.central_flicker or self.basic_flicker else 'no_flicker'
+            self.plot_files = dict()
+            self.data_files = dict()
+            self.plot_time_points = dict()
+            for name in self.log_names:
+                plot_file_name = f"../plots/{name}_basic_{flicker_kind}.txt"
+                data_file_name = f"../plots/{name}_basic_{flicker_kind}_data.txt"
+                os.makedirs(os.path.dirname(plot_file_name), exist_ok=True)
+                self.plot_files[name] = open(plot_file_name, 'w')
+                self.data_files[name] = open(data_file_name, 'w')
+                self.plot_time_points[name] = 0
 
             self.write_plot_data_at_end = False
             if self.write_plot_data_at_end:
-                # TODO: Temporal lobes
-                self.occ_1_plot_points = []
-                self.occ_2_plot_points = []
-                
-                self.occ_1_left_plot_points = []
-                self.occ_2_left_plot_points = []
-                self.occ_2_right_plot_points = []
-                self.occ_1_right_plot_points = []
+                self.plot_points = {name: [] for name in self.log_names}
 
             # File cleanup
             atexit.register(self.cleanup)
@@ -646,58 +573,17 @@ class Game:
             if self.write_plot_data_at_end:
                 self.empty_logging_queue()
             self.flicker_log_file.close()
+            self.ssvep_power_file.close()
+            self.spectrogram_file.close()
+            self.frame_timer.write_report(self.get_flicker_periods())
 
-            if self.central_flicker or not(self.basic_flicker):
-                self.occ_1_plot_file.close()
-                self.occ_2_plot_file.close()
-                self.tmp_1_plot_file.close()
-                self.tmp_2_plot_file.close()
-            else:
-                if self.right_flicker:
-                    self.occ_1_left_plot_file.close()
-                    self.occ_2_left_plot_file.close()
-                    self.tmp_1_left_plot_file.close()
-                    self.tmp_2_left_plot_file.close()
-                
-                if self.left_flicker:
-                    self.occ_1_right_plot_file.close()
-                    self.occ_2_right_plot_file.close()
-                    self.tmp_1_right_plot_file.close()
-                    self.tmp_2_right_plot_file.close()
+            for plot_file in self.plot_files.values():
+                plot_file.close()
 
             # Logging the sample rate for the FFT in the data log file
-            if self.central_flicker or not(self.basic_flicker):
-                self.occ_1_data_file.write(f"{SAMPLE_FREQ}")
-                self.occ_2_data_file.write(f"{SAMPLE_FREQ}")
-                self.occ_1_data_file.close()
-                self.occ_2_data_file.close()
-
-                self.tmp_1_data_file.write(f"{SAMPLE_FREQ}")
-                self.tmp_2_data_file.write(f"{SAMPLE_FREQ}")
-                self.tmp_1_data_file.close()
-                self.tmp_2_data_file.close()
-            else:
-                if self.right_flicker:
-                    self.occ_1_left_data_file.write(f"{SAMPLE_FREQ}")
-                    self.occ_2_left_data_file.write(f"{SAMPLE_FREQ}")
-                    self.occ_1_left_data_file.close()
-                    self.occ_2_left_data_file.close()
-
-                    self.tmp_1_left_data_file.write(f"{SAMPLE_FREQ}")
-                    self.tmp_2_left_data_file.write(f"{SAMPLE_FREQ}")
-                    self.tmp_1_left_data_file.close()
-                    self.tmp_2_left_data_file.close()
-
-                if self.left_flicker:
-                    self.occ_1_right_data_file.write(f"{SAMPLE_FREQ}")
-                    self.occ_2_right_data_file.write(f"{SAMPLE_FREQ}")
-                    self.occ_1_right_data_file.close()
-                    self.occ_2_right_data_file.close()
-                    
-                    self.tmp_1_right_data_file.write(f"{SAMPLE_FREQ}")
-                    self.tmp_2_right_data_file.write(f"{SAMPLE_FREQ}")
-                    self.tmp_1_right_data_file.close()
-                    self.tmp_2_right_data_file.close()
+            for data_file in self.data_files.values():
+                data_file.write(f"{SAMPLE_FREQ}")
+                data_file.close()
 
         def get_testing_state(self):
             return self.is_testing
@@ -725,189 +611,173 @@ class Game:
                 return 'right'
 
         def get_flicker_frequency(self):
-            # It's whole division in order to keep the reduction factor divisible by new_window_size, a.k.a. 4
-            return FPS // self.period
+            # Not necessarily a whole number: the recorded stream is cut into fractional periods (see PeriodEpocher)
+            return self.refresh_rate / self.period
         
         def get_left_flicker_frequency(self):
-            # It's whole division in order to keep the reduction factor divisible by new_window_size, a.k.a. 4
             if self.left_flicker:
-                return FPS // self.left_period
+                return self.refresh_rate / self.left_period
             elif self.right_flicker:
-                return FPS // self.right_period
+                return self.refresh_rate / self.right_period
             else:
-                return FPS // self.period
+                return self.refresh_rate / self.period
         
         def get_right_flicker_frequency(self):
-            # It's whole division in order to keep the reduction factor divisible by new_window_size, a.k.a. 4
             if self.right_flicker:
-                return FPS // self.right_period
+                return self.refresh_rate / self.right_period
             elif self.left_flicker:
-                return FPS // self.left_period
+                return self.refresh_rate / self.left_period
             else:
-                return FPS // self.period
+                return self.refresh_rate / self.period
 
-        def log_threshold_crossing(self, delta, side):
-            # self.flicker_log_file.write(f"{self.test_no}: Threshold crossed by {delta} in the {side} hs\n")
-            self.test_log[self.test_no][side] += 1 # just counting the # of activations per side for now
-        
-        def log_indeterminate_diff(self):
-            self.test_log[self.test_no]['indet'] += 1
+        def get_achievable_frequencies(self):
+            """
+            :return: list of the (frequency, period in frames, on frame counts) flicker frequencies that can be shown exactly at the refresh rate
+            """
+            return achievable_flicker_frequencies(self.refresh_rate)
+
+        def get_analysis_plan(self, sample_freq, harmonics=2):
+            """
+            The spectrum segment length (in samples, between 1 and 4 seconds) whose FFT bins fall exactly on the logged flicker frequencies,
+            and the bins of every flicker frequency and its harmonics.
+
+            :return: (segment length, dict (frequency -> list of bin indices))
+            """
+            frequencies = [frequency for (suffix, frequency) in self.get_log_conditions()]
+            segment = exact_bin_segment(frequencies, sample_freq, sample_freq, 4 * sample_freq)
+            bins = {frequency: [int(round(h * frequency * segment / sample_freq)) for h in range(1, harmonics + 1)] for frequency in frequencies}
+            return segment, bins
+
+        def log_flicker_plan(self, sample_freq):
+            segment, bins = self.get_analysis_plan(sample_freq)
+            self.flicker_log_file.write(f"Refresh rate: {self.refresh_rate:g} Hz\n"
+                                        + "Achievable flicker frequencies: "
+                                        + ", ".join(f"{frequency:.2f} Hz ({period} frames)" for (frequency, period, on_frames) in self.get_achievable_frequencies()) + "\n"
+                                        + f"Spectrum segment: {segment} samples, bins: "
+                                        + ", ".join(f"{frequency:.2f} Hz -> {frequency_bins}" for frequency, frequency_bins in bins.items()) + "\n\n")
+
+        def get_flicker_periods(self):
+            """
+            :return: dict of the flicker period (in frames) of every flickering patch ('center', 'left', 'right')
+            """
+            if not(self.basic_flicker):
+                return dict()
+            if self.central_flicker:
+                return {'center': self.period}
+            periods = dict()
+            if self.left_flicker:
+                periods['left'] = self.left_period
+            if self.right_flicker:
+                periods['right'] = self.right_period
+            return periods
+
+        def get_log_conditions(self):
+            """
+            :return: list of the (log name suffix, flicker frequency) of every logged flicker side
+            """
+            if self.central_flicker or not(self.basic_flicker):
+                return [('', self.get_flicker_frequency())]
+            # We need the contralateral lobe for each flicker, so:
+            #   Occ. lobe 1 (left) for the right-sided flicker (the '_left' logs)
+            #   Occ. lobe 2 (right) for the left-sided flicker (the '_right' logs)
+            #   and the other lobe is logged at the same frequency for reference
+            conditions = []
+            if self.right_flicker:
+                conditions.append(('_left', self.get_right_flicker_frequency()))
+            if self.left_flicker:
+                conditions.append(('_right', self.get_left_flicker_frequency()))
+            return conditions
+
+        def log_classification(self, frequency):
+            """
+            Counts an SSVEP classification of the current test: the side whose flicker frequency was detected,
+            or indeterminate if no frequency (or one shown on both sides) was detected.
+            """
+            if self.test_no >= self.no_of_tests:
+                return
+            left = self.left_flicker and frequency == self.get_left_flicker_frequency()
+            right = self.right_flicker and frequency == self.get_right_flicker_frequency()
+            if left and not right:
+                self.test_log[self.test_no]['left'] += 1
+            elif right and not left:
+                self.test_log[self.test_no]['right'] += 1
+            else:
+                self.test_log[self.test_no]['indet'] += 1
 
         # def log_error(self):
         #     self.flicker_log_file.write(f"Avg difference was >= in the wrong hs\n")
             
         def log_plot_data(self, amp, file):
             if self.write_plot_data_at_end:
-                if file == 'occ_1':
-                    self.occ_1_plot_points.append((amp, self.occ_1_plot_time_point))
-                    self.occ_1_plot_time_point += 1
-                elif file == 'occ_2':
-                    self.occ_2_plot_points.append((amp, self.occ_2_plot_time_point))
-                    self.occ_2_plot_time_point += 1
-
-                elif file == 'occ_1_left':
-                    self.occ_1_left_plot_points.append((amp, self.occ_1_left_plot_time_point))
-                    self.occ_1_left_plot_time_point += 1
-                elif file == 'occ_2_left':
-                    self.occ_2_left_plot_points.append((amp, self.occ_2_left_plot_time_point))
-                    self.occ_2_left_plot_time_point += 1
-                    
-                elif file == 'occ_1_right':
-                    self.occ_1_right_plot_points.append((amp, self.occ_1_right_plot_time_point))
-                    self.occ_1_right_plot_time_point += 1
-                elif file == 'occ_2_right':
-                    self.occ_2_right_plot_points.append((amp, self.occ_2_right_plot_time_point))
-                    self.occ_2_right_plot_time_point += 1
-                
-                # TODO: Temporals
-
+                self.plot_points[file].append((amp, self.plot_time_points[file]))
             else:
-                if file == 'occ_1':
-                    self.occ_1_plot_file.write(f"{amp} {self.occ_1_plot_time_point}\n")
-                    self.occ_1_plot_time_point += 1
-                elif file == 'occ_2':
-                    self.occ_2_plot_file.write(f"{amp} {self.occ_2_plot_time_point}\n")
-                    self.occ_2_plot_time_point += 1
-                
-                elif file == 'occ_1_left':
-                    self.occ_1_left_plot_file.write(f"{amp} {self.occ_1_left_plot_time_point}\n")
-                    self.occ_1_left_plot_time_point += 1
-                elif file == 'occ_2_left':
-                    self.occ_2_left_plot_file.write(f"{amp} {self.occ_2_left_plot_time_point}\n")
-                    self.occ_2_left_plot_time_point += 1
-
-                elif file == 'occ_1_right':
-                    self.occ_1_right_plot_file.write(f"{amp} {self.occ_1_right_plot_time_point}\n")
-                    self.occ_1_right_plot_time_point += 1
-                elif file == 'occ_2_right':
-                    self.occ_2_right_plot_file.write(f"{amp} {self.occ_2_right_plot_time_point}\n")
-                    self.occ_2_right_plot_time_point += 1
-
-                # Temporals
-                elif file == 'tmp_1':
-                    self.tmp_1_plot_file.write(f"{amp} {self.tmp_1_plot_time_point}\n")
-                    self.tmp_1_plot_time_point += 1
-                elif file == 'tmp_2':
-                    self.tmp_2_plot_file.write(f"{amp} {self.tmp_2_plot_time_point}\n")
-                    self.tmp_2_plot_time_point += 1
-
-                elif file == 'tmp_1_right':
-                    self.tmp_1_right_plot_file.write(f"{amp} {self.tmp_1_right_plot_time_point}\n")
-                    self.tmp_1_right_plot_time_point += 1
-                elif file == 'tmp_2_right':
-                    self.tmp_2_right_plot_file.write(f"{amp} {self.tmp_2_right_plot_time_point}\n")
-                    self.tmp_2_right_plot_time_point += 1
-                    
-                elif file == 'tmp_1_left':
-                    self.tmp_1_left_plot_file.write(f"{amp} {self.tmp_1_left_plot_time_point}\n")
-                    self.tmp_1_left_plot_time_point += 1
-                elif file == 'tmp_2_left':
-                    self.tmp_2_left_plot_file.write(f"{amp} {self.tmp_2_left_plot_time_point}\n")
-                    self.tmp_2_left_plot_time_point += 1
+                self.plot_files[file].write(f"{amp} {self.plot_time_points[file]}\n")
+            self.plot_time_points[file] += 1
+
+        def log_ssvep_frequencies(self, frequencies):
+            # Header line of the SSVEP power file: the frequencies of the columns (the same for every channel: O1, O2, T3, T4)
+            self.ssvep_power_file.write(" ".join(map(str, frequencies)) + "\n")
+
+        def log_ssvep_power(self, power):
+            # One line per frame: the power of every channel (rows of power) at every frequency, then the time point
+            self.ssvep_power_file.write(" ".join(map(str, power.ravel().tolist())) + f" {self.ssvep_power_time_point}\n")
+            self.ssvep_power_time_point += 1
+
+        def log_spectrum_frequencies(self, frequencies):
+            # Header line of the spectrogram file: the frequencies of the bins (the same for every channel: O1, O2, T3, T4)
+            self.spectrogram_file.write(" ".join(map(str, frequencies)) + "\n")
+
+        def log_spectra(self, spectra):
+            # One line per spectrum segment: the PSD of every channel at every bin, then the time point
+            lines = []
+            for spectrum in spectra:
+                lines.append(" ".join(map(str, spectrum.ravel().tolist())) + f" {self.spectrogram_time_point}\n")
+                self.spectrogram_time_point += 1
+            self.spectrogram_file.write("".join(lines))
 
         def log_data(self, buff, hs):
-            if hs == 'occ_1':
-                for dp in buff:
-                    self.occ_1_data_file.write(str(dp) + " ")
-                self.occ_1_data_file.write("\n")
-            elif hs == 'occ_2':
-                for dp in buff:
-                    self.occ_2_data_file.write(str(dp) + " ")
-                self.occ_2_data_file.write("\n")
-            
-            elif hs == 'occ_1_left':
-                for dp in buff:
-                    self.occ_1_left_data_file.write(str(dp) + " ")
-                self.occ_1_left_data_file.write("\n")
-            elif hs == 'occ_2_left':
-                for dp in buff:
-                    self.occ_2_left_data_file.write(str(dp) + " ")
-                self.occ_2_left_data_file.write("\n")
-                
-            elif hs == 'occ_1_right':
-                for dp in buff:
-                    self.occ_1_right_data_file.write(str(dp) + " ")
-                self.occ_1_right_data_file.write("\n")
-            elif hs == 'occ_2_right':
-                for dp in buff:
-                    self.occ_2_right_data_file.write(str(dp) + " ")
-                self.occ_2_right_data_file.write("\n")
-                
-            # Temporals
-            elif hs == 'tmp_1_right':
-                for dp in buff:
-                    self.tmp_1_right_data_file.write(str(dp) + " ")
-                self.tmp_1_right_data_file.write("\n")
-            elif hs == 'tmp_2_right':
-                for dp in buff:
-                    self.tmp_2_right_data_file.write(str(dp) + " ")
-                self.tmp_2_right_data_file.write("\n")
-            
-            elif hs == 'tmp_1_left':
-                for dp in buff:
-                    self.tmp_1_left_data_file.write(str(dp) + " ")
-                self.tmp_1_left_data_file.write("\n")
-            elif hs == 'tmp_2_left':
-                for dp in buff:
-                    self.tmp_2_left_data_file.write(str(dp) + " ")
-                self.tmp_2_left_data_file.write("\n")
-                
-            elif hs == 'tmp_1':
-                for dp in buff:
-                    self.tmp_1_data_file.write(str(dp) + " ")
-                self.tmp_1_data_file.write("\n")
-            elif hs == 'tmp_2':
-                for dp in buff:
-                    self.tmp_2_data_file.write(str(dp) + " ")
-                self.tmp_2_data_file.write("\n")
+            self.data_files[hs].write(" ".join(map(str, buff)) + " \n")
+
+        def log_epochs(self, batch, features, channels=slice(None)):
+            """
+            Logs a batch of flicker periods (see EpochEngine) at once: the features (epochs x 4, the min-max difference of every
+            channel) to the plot files and the raw samples of the segments (the given channels, in the order of LOG_CHANNELS)
+            to the data files, with one write per file.
+            Every file gets the lines of the whole batch from a single format call, on the template of the batch.
+            """
+            for condition, suffix in enumerate(self.log_suffixes):
+                rows = np.flatnonzero(batch.conditions == condition)
+                if not rows.size:
+                    continue
+                amps = features[rows].T.tolist() # channels x epochs
+                plot_template = get_plot_template(rows.size)
+
+                # The segments of a condition follow each other, so they are formatted as one (channels x samples) block,
+                # on the template of their lengths
+                segments = [batch.segments[row][channels] for row in rows]
+                samples = np.concatenate(segments, axis=1).tolist()
+                data_template = get_data_template(tuple(segment.shape[1] for segment in segments))
+
+                for channel, channel_name in enumerate(LOG_CHANNELS):
+                    name = channel_name + suffix
+                    time_point = self.plot_time_points[name]
+                    if self.write_plot_data_at_end:
+                        self.plot_points[name].extend(zip(amps[channel], range(time_point, time_point + rows.size)))
+                    else:
+                        self.plot_files[name].write(plot_template.format(amps[channel], range(time_point, time_point + rows.size)))
+                    self.plot_time_points[name] += rows.size
+                    self.data_files[name].write(data_template.format(*samples[channel]))
 
         def empty_logging_queue(self):
             # self.linearly_regress_plot_data()
-            for (amp,t) in self.occ_1_plot_points:
-                self.occ_1_plot_file.write(f"{amp} {t}\n")
-            for (amp,t) in self.occ_2_plot_points:
-                self.occ_2_plot_file.write(f"{amp} {t}\n")
+            for name, points in self.plot_points.items():
+                for (amp,t) in points:
+                    self.plot_files[name].write(f"{amp} {t}\n")
 
         def linearly_regress_plot_data(self):
-            ys_occ_1_amps = list(map(lambda t: t[0], self.occ_1_plot_points))
-            ys_occ_2_amps = list(map(lambda t: t[0], self.occ_2_plot_points))
-            no_of_data_points = len(ys_occ_1_amps)
-            xs_flicker = np.arange(0, no_of_data_points).tolist()
-            
-            reg1_flicker = LinearRegression(fit_intercept=True)
-            reg2_flicker = LinearRegression(fit_intercept=True)
-            reg1_flicker.fit(np.array(xs_flicker).reshape(-1,1), np.array(ys_occ_1_amps))
-            reg2_flicker.fit(np.array(xs_flicker).reshape(-1,1), np.array(ys_occ_2_amps))
-
-            for t in range(no_of_data_points):
-                ys_occ_1_amps_curr_drift = reg1_flicker.coef_[0] * (no_of_data_points - t)
-                ys_occ_2_amps_curr_drift = reg2_flicker.coef_[0] * (no_of_data_points - t)
-
-                ys_occ_1_amps[t] = ys_occ_1_amps[t] + ys_occ_1_amps_curr_drift - reg1_flicker.intercept_
-                ys_occ_2_amps[t] = ys_occ_2_amps[t] + ys_occ_2_amps_curr_drift - reg2_flicker.intercept_
-                
-            self.occ_1_plot_points = list(zip(ys_occ_1_amps, xs_flicker))
-            self.occ_2_plot_points = list(zip(ys_occ_2_amps, xs_flicker))
+            for name, points in self.plot_points.items():
+                amps = detrend([amp for (amp, t) in points])
+                self.plot_points[name] = list(zip(amps.tolist(), range(len(amps))))
 
         def analyze_test_run(self, test):
             side = self.test_log[test]['side']
@@ -987,6 +857,7 @@ class Game:
             Draw method for the basic (central flicker/blank screen) 60 second test
             """
             win.fill(self.FLICKER_TEST_COLOR_BG)
+            timed_test = None # The frames of the test itself are timed (see FrameTimer)
 
             # Stage 1: Countdown and instruction
             if self.test_timer_fps < self.basic_countdown_fps:
@@ -1015,42 +886,19 @@ class Game:
 
             # Stage 2: Actual test
             elif self.test_timer_fps < self.basic_test_period_fps:
+                timed_test = 'basic'
                 if not(self.has_signaled_flicker_start):
                     self.has_signaled_flicker_start = True
                 
                 if self.basic_flicker == True:
                     if self.left_flicker or self.right_flicker:
                         if self.left_flicker:
-                            if self.left_flicker_count <= self.left_flicker_on_period:
-                                left_color = self.FLICKER_TEST_COLOR_BG
-                            else:
-                                left_color = self.FLICKER_TEST_COLOR_PULSE
-                                
-                            if self.left_flicker_count == self.left_period:
-                                self.left_flicker_count = 1
-                            else:
-                                self.left_flicker_count += 1
-                        
+                            left_color = self.stimulus.get_color('left', self.stimulus_frame)
                         if self.right_flicker:
-                            if self.right_flicker_count <= self.right_flicker_on_period:
-                                right_color = self.FLICKER_TEST_COLOR_BG
-                            else:
-                                right_color = self.FLICKER_TEST_COLOR_PULSE
-                                
-                            if self.right_flicker_count == self.right_period:
-                                self.right_flicker_count = 1
-                            else:
-                                self.right_flicker_count += 1
+                            right_color = self.stimulus.get_color('right', self.stimulus_frame)
                     else:
-                        if self.flicker_count <= self.flicker_on_period:
-                            color = self.FLICKER_TEST_COLOR_BG
-                        else:
-                            color = self.FLICKER_TEST_COLOR_PULSE
-
-                        if self.flicker_count == self.period:
-                            self.flicker_count = 1
-                        else:
-                            self.flicker_count += 1
+                        color = self.stimulus.get_color('center', self.stimulus_frame)
+                    self.stimulus_frame += 1
 
                     self.is_flickering = True
                     self.is_testing = True
@@ -1093,7 +941,7 @@ class Game:
                 pygame.display.update()
                 return 0
             
-            pygame.display.update()
+            self.frame_timer.flip(pygame.display.update, timed_test)
             return 1
 
         def draw_flicker_test_window(self, win):
@@ -1101,6 +949,7 @@ class Game:
             Draw method for the flicker test
             """
             win.fill(self.FLICKER_TEST_COLOR_BG)
+            timed_test = None # The frames of the flicker tests themselves are timed (see FrameTimer)
 
             if self.test_no == self.no_of_tests:
                 end_text = self.FLICKER_FONT.render("Testing has ended", 1, "black")
@@ -1127,6 +976,7 @@ class Game:
 
             # Stage 2: The flicker test itself
             elif self.test_timer_fps < self.countdown_secs + self.single_test_period_fps:
+                timed_test = self.test_no + 1
                 # Logging
                 if not(self.has_signaled_flicker_start):
                     # self.flicker_log_file.write(f"{self.test_no}: Flickering begins ({self.get_flicker_location_string()})\n")
@@ -1141,15 +991,8 @@ class Game:
                                  self.horizontal_width, self.horizontal_height))
 
                 # Flickering patches
-                if self.flicker_count <= self.flicker_on_period:
-                    color = self.FLICKER_TEST_COLOR_BG
-                else:
-                    color = self.FLICKER_TEST_COLOR_PULSE
-
-                if self.flicker_count == self.period:
-                    self.flicker_count = 1
-                else:
-                    self.flicker_count += 1
+                color = self.stimulus.get_color('center', self.stimulus_frame)
+                self.stimulus_frame += 1
 
                 pygame.draw.rect(win, color,
                                 (self.flicker_left_x, self.flicker_y,
@@ -1177,7 +1020,7 @@ class Game:
                     self.analyze_tests()
                     # self.flicker_log_file.write("Testing done")
 
-            pygame.display.update()
+            self.frame_timer.flip(pygame.display.update, timed_test)
             return 1
 
         # def draw_flicker_test_window_complete(self, win):
@@ -1423,7 +1266,8 @@ class Game:
         #                            Originally: x:90  y:WIN_HEIGHT - 120                           
 
         # TODO: Change the FlickerWindow object instantiation so that there is only one period and flicker_on option
-        flicker_window = self.FlickerWindow(flicker_on=True, right_period=3, right_flicker_on_period=1)
+        flicker_window = self.FlickerWindow(refresh_rate=self.FPS, flicker_on=True,
+                                            right_period=flicker_period(self.FPS, RIGHT_FLICKER_FREQ), right_flicker_on_period=1)
         #                                   period=2 - 1 flicker color change every frame,
         #                                              2 frame flicker period,
         #                                              30 Hz
@@ -1432,57 +1276,67 @@ class Game:
         #                                              15 Hz
         
         if flicker_window.get_flicker_location() == 'center':
-            reduction_factor_full = SAMPLE_FREQ / flicker_window.get_flicker_frequency()
-
-            # reduction_factor_int is a multiple of new_data_window_size, since the flicker frequency is a submultiple of FPS
-            reduction_factor_int = SAMPLE_FREQ // flicker_window.get_flicker_frequency()
-
-            reduction_factor_error = reduction_factor_full - reduction_factor_int
-            error_recovery_threshold = np.rint(1 / reduction_factor_error)
-
-            # TODO: Handle the case when error_recovery_threshold has a fractional part
-            # error_recovery_threshold_frac = np.modf(error_recovery_threshold)[0]
-            # if error_recovery_threshold_frac:
-            #     mult_factor = 1 / error_recovery_threshold_frac
-            #     error_recovery_threshold = np.rint(mult_factor * error_recovery_threshold)
-
-            error_recovery_counter = 0
-
-            # Debugging - TODO: remove
-            # print(f"flicker period: {flicker_window.period}")
-            # print(f"flicker frequency: {flicker_window.get_flicker_frequency()}")
-            # print(f"reduction_factor_full: {reduction_factor_full}")
-            # print(f"reduction_factor_int: {reduction_factor_int}")
-            # print(f"reduction_factor_error: {reduction_factor_error}")
-            # print(f"error_recovery_threshold: {error_recovery_threshold}")
-
+            stimulus_frequencies = [flicker_window.get_flicker_frequency()]
         else:
-            # We need the contralateral lobe for each flicker, so:
-            #   Occ. lobe 1 (left) for the right-sided flicker
-            #   Occ. lobe 2 (right) for the left-sided flicker
-            
-            if 'right' in flicker_window.get_flicker_location():
-                reduction_factor_full_left = SAMPLE_FREQ / flicker_window.get_right_flicker_frequency()
-
-                # reduction_factor_int is a multiple of new_data_window_size, since the flicker frequency is a submultiple of FPS
-                reduction_factor_int_left = SAMPLE_FREQ // flicker_window.get_right_flicker_frequency()
-                
-                reduction_factor_error_left = reduction_factor_full_left - reduction_factor_int_left
-                error_recovery_threshold_left = np.rint(1 / reduction_factor_error_left)
-                
-                error_recovery_counter_left = 0
-
-            if 'left' in flicker_window.get_flicker_location():
-                reduction_factor_full_right = SAMPLE_FREQ / flicker_window.get_left_flicker_frequency()
-
-                # reduction_factor_int is a multiple of new_data_window_size, since the flicker frequency is a submultiple of FPS
-                reduction_factor_int_right = SAMPLE_FREQ // flicker_window.get_left_flicker_frequency()
-                
-                reduction_factor_error_right = reduction_factor_full_right - reduction_factor_int_right
-                error_recovery_threshold_right = np.rint(1 / reduction_factor_error_right)
-                
-                error_recovery_counter_right = 0
-
+            stimulus_frequencies = sorted({flicker_window.get_left_flicker_frequency(),
+                                           flicker_window.get_right_flicker_frequency()})
+        # The synthetic backend generates its SSVEP responses at the flicker frequencies
+        mySensor.set_stimulus_frequencies(stimulus_frequencies)
+        flicker_window.log_ssvep_frequencies(stimulus_frequencies)
+
+        def check_contact(packet):
+            # The flicker periods recorded while an occipital electrode has a bad contact are discarded
+            packet['contact_ok'] = mySensor.is_contact_good((0, 1))
+            return packet
+
+        def log_ssvep(packet):
+            if packet['contact_ok']:
+                flicker_window.log_ssvep_power(packet['power'])
+                if packet['spectra'].shape[0]:
+                    flicker_window.log_spectra(packet['spectra'])
+                if packet['batch'].conditions.size:
+                    # The raw channels are stacked under the filtered ones in the epochs (see EpochStage)
+                    flicker_window.log_epochs(packet['batch'], packet['features'], channels=slice(4, 8))
+            return packet
+
+        # Every sample received since the previous frame is read exactly once, and goes through:
+        #   the band-pass and the notches at the mains and screen refresh frequencies (all 4 channels),
+        #   the SSVEP power at the flicker frequencies (and their harmonics), tracked sample by sample,
+        #   the spectra of the overlapping 1 second segments (spectrogram),
+        #   the classification of the last second as one of the flicker frequencies,
+        #   the cut into exact flicker periods of every logged flicker side (a fractional number of samples) and their min-max differences
+        # The spectrum segments are sized so that the flicker frequencies fall on exact bins
+        spectrum_segment = flicker_window.get_analysis_plan(SAMPLE_FREQ)[0]
+        flicker_window.log_flicker_plan(SAMPLE_FREQ)
+        ssvep_pipeline = Pipeline(SensorSource(mySensor),
+                                  [FunctionStage('contact', check_contact)] +
+                                  ssvep_stages(stimulus_frequencies, [frequency for (suffix, frequency) in flicker_window.get_log_conditions()],
+                                               sample_freq=SAMPLE_FREQ, notches=(MAINS_FREQ, self.FPS), spectrum_segment=spectrum_segment) +
+                                  [FunctionStage('log', log_ssvep)])
+        flicker_window.log_spectrum_frequencies(ssvep_pipeline.get_stage('spectrum').engine.frequencies)
+
+        was_testing = False
+
+        def dsp_step():
+            # Runs on the scheduler's worker, the pipeline only reads the sensor while a flicker test is running
+            nonlocal was_testing
+            testing = self.flicker_test and flicker_window.get_testing_state()
+            if testing and not was_testing:
+                # Every test starts over from its first sample: the samples received since the previous test are skipped,
+                # and the filters, the SSVEP windows and the epochs (in phase with the stimulus onset) start again
+                ssvep_pipeline.reset()
+            was_testing = testing
+            if not testing:
+                return None
+            packet = ssvep_pipeline.step()
+            if packet != None and packet['contact_ok']:
+                return packet['classification']
+            return None
+
+        # The signal processing runs on a worker, the render loop only picks up its latest classification (and never waits on it)
+        scheduler = FrameScheduler(self.FPS)
+        scheduler.start_worker(dsp_step)
+        classification_version = 0
 
         bricks = self.generate_bricks(1, 10)
         lives = MAX_LIVES
@@ -1502,23 +1356,15 @@ class Game:
             pygame.time.delay(3000)
 
         # Initializating the EEG variables for blinking detection:
-        xs = np.arange(0,100).tolist()
-        ys = [list(), list(), list(), list()]
-        ys1_last = [0] * 100
-        ys2_last = [0] * 100
-        ys3_last = [0] * 100
-        ys4_last = [0] * 100
-        reg1 = LinearRegression(fit_intercept=True)
-        reg2 = LinearRegression(fit_intercept=True)
-        reg3 = LinearRegression(fit_intercept=True)
-        reg4 = LinearRegression(fit_intercept=True)
-        blinked_bool = 0
-        blinked_count = 0
+        # The blinks are detected on the acquisition path, as the samples arrive, and queued for the render loop,
+        # which moves the paddle (the game state is only touched by the render thread)
+        # A blink thus moves the paddle at the next frame, at most 1 / FPS after its detection, when the move is drawn anyway
+        blink_detector = BlinkDetector(BLINK_THRESHOLD, sample_freq=SAMPLE_FREQ, drift_window=DRIFT_WINDOW)
+        blink_events = deque()
+        blink_detector.add_listener(blink_events.append)
+        mySensor.add_listener(blink_detector.on_samples)
 
         # Initializating the EEG variables for flicker-induced SSVEP detection:
-        new_data_window_size = SAMPLE_FREQ // FPS
-        # roughly 250 Hz // 60 Hz = 4 new data points are added each refresh
-        # print(f"new_data_window_size: {new_data_window_size}")
 
         window_size = 100 
         # initial_window_size = reduction_factor * window_size
@@ -1533,21 +1379,6 @@ class Game:
         # ys4_flicker = [0] * window_size
         # ys_occ_1 = []
         # ys_occ_2 = []
-        ys_occ_1_new = []
-        ys_occ_2_new = []
-        ys_occ_1_left_new = []
-        ys_occ_1_right_new = []
-        ys_occ_2_left_new = []
-        ys_occ_2_right_new = []
-
-        # Temporals
-        ys_tmp_1_new = []
-        ys_tmp_2_new = []
-        ys_tmp_1_left_new = []
-        ys_tmp_1_right_new = []
-        ys_tmp_2_left_new = []
-        ys_tmp_2_right_new = []
-
         # ys_occ_1_old = None
         # ys_occ_2_old = None
         # reg1_flicker = LinearRegression(fit_intercept=True)
@@ -1561,7 +1392,7 @@ class Game:
         flicker_test_button = Button(250, 500, "Flicker Test", self.button_background_img, 2)
         quit_button = Button(250, 600, "Quit", self.button_background_img, 2)
 
-        readThread = Thread(target=reading_task, args=[self.EEGSensor])
+        connectThread = None # The device scan and connection runs in the background, so the menu keeps responding
 
         connect_text = self.MENU_TEXT_FONT.render('Connection:', True, (0, 0, 0))
         connect_textRect = connect_text.get_rect()
@@ -1574,7 +1405,9 @@ class Game:
         # MainLoop:
         run = True
         while run:
+            scheduler.end_frame()
             clock.tick(self.FPS)
+            scheduler.begin_frame()
 
             for event in pygame.event.get():
                 if event.type == pygame.KEYDOWN:
@@ -1586,19 +1419,33 @@ class Game:
                     run = False
                     break
 
+            # The blink events queued by the acquisition path since the last frame (only the game uses them)
+            blinks = [blink_events.popleft() for _ in range(len(blink_events))]
             
             if self.main_menu == True:
                 self.win.fill((200, 230, 240))
 
                 self.win.blit(connect_text, connect_textRect)
                 self.win.blit(reading_text, reading_textRect)
+                if connectThread != None and not connectThread.is_alive():
+                    connectThread = None
+                    try:
+                        if self.EEGSensor.is_connected():
+                            self.connection_flag = True
+                    except Exception as err:
+                        print(err)
+
                 if self.connection_flag == True:
                     pygame.draw.rect(self.win, (0, 255, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 60, 20, 20))
+                elif connectThread != None:
+                    pygame.draw.rect(self.win, (255, 255, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 60, 20, 20))
                 else:
                     pygame.draw.rect(self.win, (255, 0, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 60, 20, 20))
 
-                if readThread.is_alive():
+                if self.acquisition.is_recording():
                     pygame.draw.rect(self.win, (0, 255, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 30, 20, 20))
+                elif self.acquisition.is_streaming(): # Paused
+                    pygame.draw.rect(self.win, (255, 255, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 30, 20, 20))
                 else:
                     pygame.draw.rect(self.win, (255, 0, 0), pygame.Rect(WIN_WIDTH - 30, WIN_HEIGHT - 30, 20, 20))
                 
@@ -1616,20 +1463,18 @@ class Game:
                     difficulty_button.text = "Difficulty: " + str(self.difficulty)
 
                 if connect_button.draw(self.win):
-                    self.EEGSensor.activate_sensor()
-    
-                    try:
-                        if self.EEGSensor.sensor.name == "BrainBit":
-                            self.connection_flag = True
-                    except Exception as err:
-                        print(err)
+                    if connectThread == None and not self.connection_flag:
+                        connectThread = Thread(target=self.EEGSensor.activate_sensor, daemon=True)
+                        connectThread.start()
 
                 if start_reading_button.draw(self.win):
-                    if readThread.is_alive():
-                        readThread.start()
+                    # The device keeps streaming once started, the button only pauses and resumes the recording
+                    if not self.acquisition.is_streaming():
+                        self.acquisition.start()
+                    elif self.acquisition.is_recording():
+                        self.acquisition.pause()
                     else:
-                        readThread = Thread(target=reading_task, args=[self.EEGSensor])
-                        readThread.start()
+                        self.acquisition.resume()
 
                 if flicker_test_button.draw(self.win):
                     self.main_menu = False
@@ -1646,207 +1491,22 @@ class Game:
                     continue
 
                 if flicker_window.get_testing_state():
-
-                    # new_batch_size_left = min(new_data_window_size, reduction_factor_int_left - len(ys_occ_1_new))
-                    # new_batch_size_right = min(new_data_window_size, reduction_factor_int_right - len(ys_occ_2_new))
-
-                    # The buffers where each lobe (1 and 2) is updated by its corresponding batch size (left and right),
-                    #       as determined using the flicker frequency on each side
-                    # ys_occ_1_left_new += mySensor.get_data()[0][-new_batch_size_left:]
-                    # ys_occ_2_right_new += mySensor.get_data()[1][-new_batch_size_right:]
-
-                    # The buffers where each lobe (1 and 2) is updated by the oher's batch size (right and left),
-                    #       as determined using the flicker frequency on each side
-                    # ys_occ_1_right_new += mySensor.get_data()[0][-new_batch_size_right:]
-                    # ys_occ_2_left_new += mySensor.get_data()[1][-new_batch_size_left:]
-                    
-                    if flicker_window.get_flicker_location() == 'center':
-                        new_batch_size = min(new_data_window_size, reduction_factor_int - len(ys_occ_1_new))
-                        ys_occ_1_new += mySensor.get_data()[0][-new_batch_size:] # Occ. electrode 1, left hemisphere
-                        ys_occ_2_new += mySensor.get_data()[1][-new_batch_size:] # Occ. electrode 2, right hemisphere
-
-                        ys_tmp_1_new += mySensor.get_data()[0][-new_batch_size:] # Tmp. electrode 1, left hemisphere
-                        ys_tmp_2_new += mySensor.get_data()[1][-new_batch_size:] # Tmp. electrode 2, right hemisphere
-
-                        if len(ys_occ_1_new) == reduction_factor_int:
-                            # A new batch corresp. to 1 flicker period is complete
-                            error_recovery_counter += 1
-                            if error_recovery_counter == error_recovery_threshold:
-                                ys_occ_1_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                ys_occ_2_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                ys_tmp_1_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                ys_tmp_2_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                error_recovery_counter = 0
-
-                            ys_occ_1_min_max_diff = max(ys_occ_1_new) - min(ys_occ_1_new)
-                            ys_occ_2_min_max_diff = max(ys_occ_2_new) - min(ys_occ_2_new)
-                            
-                            ys_tmp_1_min_max_diff = max(ys_tmp_1_new) - min(ys_tmp_1_new)
-                            ys_tmp_2_min_max_diff = max(ys_tmp_2_new) - min(ys_tmp_2_new)
-                            
-                            flicker_window.log_plot_data(ys_occ_1_min_max_diff, 'occ_1')
-                            flicker_window.log_plot_data(ys_occ_2_min_max_diff, 'occ_2')
-                            flicker_window.log_data(ys_occ_1_new, 'occ_1')
-                            flicker_window.log_data(ys_occ_2_new, 'occ_2')
-
-                            flicker_window.log_plot_data(ys_tmp_1_min_max_diff, 'tmp_1')
-                            flicker_window.log_plot_data(ys_tmp_2_min_max_diff, 'tmp_2')
-                            flicker_window.log_data(ys_tmp_1_new, 'tmp_1')
-                            flicker_window.log_data(ys_tmp_2_new, 'tmp_2')
-                            
-                            ys_occ_1_new = []
-                            ys_occ_2_new = []
-                            ys_tmp_1_new = []
-                            ys_tmp_2_new = []
-                    else:
-                        if 'right' in flicker_window.get_flicker_location():
-                            # Processing the data registered by the left (1) occipital lobe at the right eye flicker frequency,
-                            #   and logging the right (2) occipital lobe data at the same (contralatral) frequency for reference
-                            
-                            new_batch_size_left = min(new_data_window_size, reduction_factor_int_left - len(ys_occ_1_left_new))
-
-                            # Occ. lobe 1 (left) buffer is updated with its corresponding left batch size,
-                            #   while the occ. lobe 2 (right) buffer is updated with the same (so contralateral)
-                            #   left batch size
-                            ys_occ_1_left_new += mySensor.get_data()[0][-new_batch_size_left:]
-                            ys_occ_2_left_new += mySensor.get_data()[1][-new_batch_size_left:]
-                            
-                            ys_tmp_1_left_new += mySensor.get_data()[0][-new_batch_size_left:]
-                            ys_tmp_2_left_new += mySensor.get_data()[1][-new_batch_size_left:]
-
-                            if len(ys_occ_1_left_new) == reduction_factor_int_left:
-                                # A new batch corresp. to 1 flicker period is complete
-                                error_recovery_counter_left += 1
-                                if error_recovery_counter_left == error_recovery_threshold_left:
-                                    ys_occ_1_left_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                    ys_occ_2_left_new.append(mySensor.get_data()[1][-(new_data_window_size + 1)])
-                                    ys_tmp_1_left_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                    ys_tmp_2_left_new.append(mySensor.get_data()[1][-(new_data_window_size + 1)])
-                                    error_recovery_counter_left = 0
-
-                                ys_occ_1_left_min_max_diff = max(ys_occ_1_left_new) - min(ys_occ_1_left_new)
-                                flicker_window.log_plot_data(ys_occ_1_left_min_max_diff, 'occ_1_left')
-                                flicker_window.log_data(ys_occ_1_left_new, 'occ_1_left')
-                                ys_occ_1_left_new = []
-
-                                # The second lobe, for comparison
-                                ys_occ_2_left_min_max_diff = max(ys_occ_2_left_new) - min(ys_occ_2_left_new)
-                                flicker_window.log_plot_data(ys_occ_2_left_min_max_diff, 'occ_2_left')
-                                flicker_window.log_data(ys_occ_2_left_new, 'occ_2_left')
-                                ys_occ_2_left_new = []
-
-                                # Temporals
-                                ys_tmp_1_left_min_max_diff = max(ys_tmp_1_left_new) - min(ys_tmp_1_left_new)
-                                flicker_window.log_plot_data(ys_tmp_1_left_min_max_diff, 'tmp_1_left')
-                                flicker_window.log_data(ys_tmp_1_left_new, 'tmp_1_left')
-                                ys_tmp_1_left_new = []
-
-                                ys_tmp_2_left_min_max_diff = max(ys_tmp_2_left_new) - min(ys_tmp_2_left_new)
-                                flicker_window.log_plot_data(ys_tmp_2_left_min_max_diff, 'tmp_2_left')
-                                flicker_window.log_data(ys_tmp_2_left_new, 'tmp_2_left')
-                                ys_tmp_2_left_new = []
-
-                        if 'left' in flicker_window.get_flicker_location():
-                            # Processing the data registered by the right (2) occipital lobe at the left eye flicker frequency,
-                            #   and logging the left (1) occipital lobe data at the same (contralatral) frequency for reference
-                        
-                            new_batch_size_right = min(new_data_window_size, reduction_factor_int_right - len(ys_occ_2_right_new))
-                        
-                            # Occ. lobe 2 (right) buffer is updated with its corresponding right batch size,
-                            #   while the occ. lobe 1 (left) buffer is updated with the same (so contralateral)
-                            #   right batch size
-                            ys_occ_2_right_new += mySensor.get_data()[1][-new_batch_size_right:]
-                            ys_occ_1_right_new += mySensor.get_data()[0][-new_batch_size_right:]
-                            
-                            ys_tmp_2_right_new += mySensor.get_data()[1][-new_batch_size_right:]
-                            ys_tmp_1_right_new += mySensor.get_data()[0][-new_batch_size_right:]
-
-                            if len(ys_occ_2_right_new) == reduction_factor_int_right:
-                                # A new batch corresp. to 1 flicker period is complete
-                                error_recovery_counter_right += 1
-                                if error_recovery_counter_right == error_recovery_threshold_right:
-                                    ys_occ_2_right_new.append(mySensor.get_data()[1][-(new_data_window_size + 1)])
-                                    ys_occ_1_right_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                    ys_tmp_2_right_new.append(mySensor.get_data()[1][-(new_data_window_size + 1)])
-                                    ys_tmp_1_right_new.append(mySensor.get_data()[0][-(new_data_window_size + 1)])
-                                    error_recovery_counter_left = 0
-
-                                ys_occ_2_right_min_max_diff = max(ys_occ_2_right_new) - min(ys_occ_2_right_new)
-                                flicker_window.log_plot_data(ys_occ_2_right_min_max_diff, 'occ_2_right')
-                                flicker_window.log_data(ys_occ_2_right_new, 'occ_2_right')
-                                ys_occ_2_right_new = []
-
-                                # The first lobe, for comparison
-                                ys_occ_1_right_min_max_diff = max(ys_occ_1_right_new) - min(ys_occ_1_right_new)
-                                flicker_window.log_plot_data(ys_occ_1_right_min_max_diff, 'occ_1_right')
-                                flicker_window.log_data(ys_occ_1_right_new, 'occ_1_right')
-                                ys_occ_1_right_new = []
-
-                                # Temporal
-                                ys_tmp_2_right_min_max_diff = max(ys_tmp_2_right_new) - min(ys_tmp_2_right_new)
-                                flicker_window.log_plot_data(ys_tmp_2_right_min_max_diff, 'tmp_2_right')
-                                flicker_window.log_data(ys_tmp_2_right_new, 'tmp_2_right')
-                                ys_tmp_2_right_new = []
-
-                                ys_tmp_1_right_min_max_diff = max(ys_tmp_1_right_new) - min(ys_tmp_1_right_new)
-                                flicker_window.log_plot_data(ys_tmp_1_right_min_max_diff, 'tmp_1_right')
-                                flicker_window.log_data(ys_tmp_1_right_new, 'tmp_1_right')
-                                ys_tmp_1_right_new = []
-
+                    classification_version, classification = scheduler.slot.take_new(classification_version)
+                    if classification != None:
+                        flicker_window.log_classification(classification[0])
             else:
-                # Stage 1: Preparing the EEG data (absolute amplitude correction) for the blinking detection
-                for j in range(4):
-                    ys[j] = mySensor.get_data()[j][-100:]
-
-                # Simply uncomment the respective lines if you want to use the other channels as well
-                if len(ys[0]) == 100:
-                    reg1.fit(np.array(xs).reshape(-1,1), np.array(ys[0]))
-                    reg2.fit(np.array(xs).reshape(-1,1), np.array(ys[1]))
-                    #reg3.fit(np.array(xs).reshape(-1,1), np.array(ys[2]))
-                    # reg4.fit(np.array(xs).reshape(-1,1), np.array(ys[3]))
-
-                    for t in range(100):
-                        ys1_curr_drift = reg1.coef_ * (100 - t)
-                        ys2_curr_drift = reg2.coef_ * (100 - t)
-                        #ys3_curr_drift = reg3.coef_ * (100 - t)
-                        #ys4_curr_drift = reg4.coef_ * (100 - t)
-                        
-                        ys1_last[t] = ys[0][t] + ys1_curr_drift - reg1.intercept_
-                        ys2_last[t] = ys[1][t] + ys2_curr_drift - reg2.intercept_
-                        #ys3_last[t] = ys[2][t] + ys3_curr_drift - reg3.intercept_
-                        # ys4_last[t] = ys[3][t] + ys4_curr_drift - reg4.intercept_
-
-                # TODO: Correct the amplitude drift without affecting the reltative amplitude differences
-                # self.log_current_data_buffer(ys1_last, 'occ_1')
-                # self.log_current_data_buffer(ys2_last, 'occ_2')
-
-                # Moving the ball based on player controls (currently: blinking)
-                if self.direction != 0 and ball.y_vel > 0:
-                    if self.direction == 1:
-                        if blinked_bool == 0:
-                            # TODO: Set a maximum threshold to prevent detecting the pulse as a blink
-                            if (np.average(ys1_last[0:99]) - np.average(ys1_last[80:90]) > BLINK_THRESHOLD) and paddle.x + paddle.width + paddle.VEL <= self.WIDTH:
-                                # paddle.move(self.direction)
-                                paddle.move_to_final_location(ball.x_predict, self.steps_needed, self.direction)
-                                blinked_bool = 1
-                                self.steps_taken += 1
-                        else:
-                            blinked_count += 1
-                            if blinked_count >= 10:
-                                blinked_bool = 0
-                                blinked_count = 0
-                    elif self.direction == -1:
-                        if blinked_bool == 0:
-                            if (np.average(ys1_last[0:99]) - np.average(ys1_last[80:90]) > BLINK_THRESHOLD) and paddle.x - paddle.VEL >= 0:
-                                # paddle.move(self.direction)
-                                paddle.move_to_final_location(ball.x_predict, self.steps_needed, self.direction)
-                                blinked_bool = 1
-                                self.steps_taken += 1
-                        else:
-                            blinked_count += 1
-                            if blinked_count >= 10:
-                                blinked_bool = 0
-                                blinked_count = 0
+                # The paddle is moved by the blinks detected since the last frame
+                for _ in blinks:
+                    # No blink is taken into account while an occipital electrode has a bad contact
+                    if not mySensor.is_contact_good((0, 1)):
+                        break
+                    # TODO: Set a maximum threshold to prevent detecting the pulse as a blink
+                    if self.direction != 0 and ball.y_vel > 0:
+                        if (self.direction == 1 and paddle.x + paddle.width + paddle.VEL <= self.WIDTH) or \
+                           (self.direction == -1 and paddle.x - paddle.VEL >= 0):
+                            # paddle.move(self.direction)
+                            paddle.move_to_final_location(ball.x_predict, self.steps_needed, self.direction)
+                            self.steps_taken += 1
 
                 self.fix_ball_conditions(ball)
                 ball.move()
@@ -1903,13 +1563,36 @@ class Game:
                 self.draw(self.win, paddle, ball, bricks, gauge, lives, self.direction, 1)
 
         
-        if readThread.is_alive():
-            self.EEGSensor.threading_event.set()
-            readThread.join()
+        scheduler.stop_worker()
+        print(f"Frame scheduler statistics: {scheduler.get_stats()}")
+        self.acquisition.stop()
+        if ssvep_pipeline.source.calls:
+            ssvep_pipeline.print_stats(file=flicker_window.flicker_log_file)
+        print(f"Acquisition statistics: {self.EEGSensor.get_acquisition_stats()}")
         self.EEGSensor.deactivate_sensor()
         print("\nDeactivation of sensor completed!\n")
         pygame.quit()
 
 if __name__ == "__main__":
-    brickGame = Game()
-    brickGame.main()
\ No newline at end of file
+    # Command format is: python3 ./brickGame.py [process] [replay <speed> [recording files/directories] | synthetic <speed>]
+    error_msg = "Command format is: python3 ./brickGame.py [process] [replay <speed> [recording files/directories] | synthetic <speed>]"
+    args = sys.argv[1:]
+    out_of_process = len(args) > 0 and args[0] == 'process'
+    if out_of_process:
+        args = args[1:]
+
+    backend_factory = None
+    if len(args) > 0 and args[0] == 'replay':
+        if len(args) < 3:
+            sys.exit(error_msg)
+        # The paths are resolved before the Game changes the working directory
+        backend_factory = partial(ReplayBackend, [os.path.abspath(p) for p in args[2:]], speed=float(args[1]))
+    elif len(args) > 0 and args[0] == 'synthetic':
+        if len(args) < 2:
+            sys.exit(error_msg)
+        backend_factory = partial(SyntheticBackend, speed=float(args[1]))
+    elif len(args) > 0:
+        sys.exit(error_msg)
+
+    brickGame = Game(backend_factory, out_of_process)
+    brickGame.main()
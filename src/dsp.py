@@ -0,0 +1,472 @@
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
+from ring_buffer import RingBuffer
+
+# Initializations of some static variables:
+BAND_PASS = (4, 45) # Hz, the band kept before the SSVEP detection (stimulus frequencies and their second harmonics)
+MAINS_FREQ = 50 # Hz, the power line frequency
+REFRESH_FREQ = 60 # Hz, the screen refresh rate
+NOTCH_Q = 30 # Quality factor of the notches (bandwidth = frequency / Q)
+BUTTERWORTH_Q = 1 / np.sqrt(2)
+MAX_FILTER_BLOCK = 64 # samples, longer blocks are filtered in chunks (the block matrices grow with the square of the length)
+SPECTRUM_OVERLAP = 0.5 # Overlap of consecutive spectrum segments
+
+
+@lru_cache(maxsize=None)
+def centered_ramp(n):
+    """
+    Returns the (read-only) sample indices 0..n-1 minus their mean, the regressor of the linear trend of an n sample window.
+    """
+    ramp = np.arange(n) - (n - 1) / 2
+    ramp.flags.writeable = False
+    return ramp
+
+
+def linear_trend(data):
+    """
+    Least-squares fit of a line over the last axis of data (a window, or a (channels x window) array), in closed form:
+        slope = sum((x - mean(x)) * y) / sum((x - mean(x)) ** 2), intercept = mean(y) - slope * mean(x)
+
+    :return: (slope, intercept) arrays with the shape of data without its last axis
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[-1]
+    ramp = centered_ramp(n)
+    mean = data.mean(axis=-1)
+    slope = data @ ramp / (ramp @ ramp) if n > 1 else np.zeros_like(mean)
+    return slope, mean - slope * (n - 1) / 2
+
+
+def detrend(data):
+    """
+    Removes the linear trend (drift) from every row of data (a window, or a (channels x window) array) in one vectorized pass.
+
+    :return: numpy array of the residuals, shaped like data
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[-1]
+    mean = data.mean(axis=-1, keepdims=True)
+    if n < 2:
+        return data - mean
+    ramp = centered_ramp(n)
+    slope = data @ ramp / (ramp @ ramp)
+    return data - mean - slope[..., None] * ramp
+
+
+class RunningSums:
+    def __init__(self, window, refresh):
+        """
+        Keeps the running sums of a sliding window exact. Sums updated with the entering and leaving samples only pile up
+        rounding errors, so refresh() (which recomputes them from the samples in the window) is called once every window samples.
+        """
+        self.window = window
+        self.refresh = refresh
+        self.since_refresh = 0
+
+    def advance(self, n):
+        """
+        Counts n new samples, recomputing the sums if window samples were added since the last refresh.
+        """
+        self.since_refresh += n
+        if self.since_refresh >= self.window:
+            self.since_refresh = 0
+            self.refresh()
+
+    def reset(self):
+        self.since_refresh = 0
+
+
+class StreamingDetrender:
+    def __init__(self, channels, window):
+        """
+        Initialization of the streaming detrender, which fits a line over the last window samples of every channel.
+        The running sums sum(y) and sum(x * y) (x being the position in the window) are updated in O(1) per sample
+        (sum(x) and sum(x ** 2) only depend on the window length), so the cost does not grow with the window.
+        Every new sample is detrended against the fit of the window ending at it, as soon as it arrives.
+        """
+        self.channels = channels
+        self.window = window
+        self.running_sums = RunningSums(window, self.refresh)
+        self.reset()
+
+    def reset(self):
+        """
+        Empties the window, so that the next sample starts a new fit.
+        """
+        self.history = RingBuffer(self.channels, self.window)
+        self.sum_y = np.zeros(self.channels)
+        self.sum_xy = np.zeros(self.channels)
+        self.running_sums.reset()
+
+    def __len__(self):
+        return len(self.history)
+
+    def update(self, block):
+        """
+        Adds a (channels x n) block of samples to the window.
+
+        :return: (channels x n numpy array) the detrended block
+        """
+        block = np.asarray(block, dtype=np.float64)
+        detrended = np.empty_like(block)
+        start = 0
+        while start < block.shape[1]:
+            if len(self.history) < self.window:
+                # The window is still growing (it starts at the first sample)
+                step = min(block.shape[1] - start, self.window - len(self.history))
+                detrended[:, start:start + step] = self.fill(block[:, start:start + step])
+            else:
+                step = min(block.shape[1] - start, self.window)
+                detrended[:, start:start + step] = self.slide(block[:, start:start + step])
+            start += step
+        return detrended
+
+    def fill(self, block):
+        """
+        Detrends a block that fits into the part of the window that is not filled yet.
+        """
+        filled = len(self.history)
+        positions = np.arange(filled, filled + block.shape[1])
+        n = positions + 1 # Window length after each sample
+        sum_y = self.sum_y[:, None] + np.cumsum(block, axis=1)
+        sum_xy = self.sum_xy[:, None] + np.cumsum(block * positions, axis=1)
+
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        denominator = n * sum_xx - sum_x ** 2
+        slope = np.divide(n * sum_xy - sum_x * sum_y, denominator, out=np.zeros_like(sum_y), where=denominator > 0)
+        intercept = (sum_y - slope * sum_x) / n
+
+        self.sum_y, self.sum_xy = sum_y[:, -1], sum_xy[:, -1]
+        self.history.extend(block)
+        return block - intercept - slope * positions
+
+    def slide(self, block):
+        """
+        Detrends a block of at most window samples once the window is full, each sample pushing the oldest one out.
+        For each new sample y (and leaving sample o): sum_xy -= sum_y - o, then sum_xy += (window - 1) * y and sum_y += y - o,
+        which is evaluated for the whole block at once with cumulative sums.
+        """
+        window = self.window
+        leaving = self.history.tail()[:, :block.shape[1]]
+        entering_sums = np.cumsum(block, axis=1)
+        leaving_sums = np.cumsum(leaving, axis=1)
+        sum_y = self.sum_y[:, None] + entering_sums - leaving_sums
+        previous_sum_y = np.concatenate((self.sum_y[:, None], sum_y[:, :-1]), axis=1)
+        sum_xy = self.sum_xy[:, None] - np.cumsum(previous_sum_y, axis=1) + leaving_sums + (window - 1) * entering_sums
+
+        # The fitted line, evaluated at the newest sample (x = window - 1)
+        ramp = centered_ramp(window)
+        slope = (sum_xy - sum_y * (window - 1) / 2) / (ramp @ ramp)
+        detrended = block - sum_y / window - slope * (window - 1) / 2
+
+        self.sum_y, self.sum_xy = sum_y[:, -1], sum_xy[:, -1]
+        self.history.extend(block)
+        self.running_sums.advance(block.shape[1])
+        return detrended
+
+    def refresh(self):
+        """
+        Recomputes the window sums from the samples in the (full) window.
+        """
+        samples = self.history.tail()
+        self.sum_y = samples.sum(axis=1)
+        self.sum_xy = samples @ np.arange(self.window)
+
+
+EpochBatch = namedtuple('EpochBatch', ['conditions', 'epochs', 'segments'])
+
+
+class EpochEngine:
+    def __init__(self, periods, channels=4, samples_per_epoch=None):
+        """
+        Initialization of the epoching engine, which cuts the stream into consecutive stimulus periods for several
+        conditions (flicker targets) at once, periods being the period of every condition in samples
+        (sample frequency / stimulus frequency, not necessarily a whole number).
+        Epoch k of a condition covers the sample positions [k * period, (k + 1) * period) from the first sample, and is resampled
+        (by linear interpolation) onto samples_per_epoch evenly spaced points (ceil of the longest period by default),
+        so that the epochs of all the conditions and channels fit in one array and stay in phase with their stimulus.
+        The samples are kept once for all the conditions, and a block is epoched with one gather for all of them.
+        """
+        self.periods = np.array(periods, dtype=np.float64)
+        self.samples_per_epoch = samples_per_epoch or int(np.ceil(self.periods.max()))
+        self.grids = np.arange(self.samples_per_epoch)[None, :] * (self.periods / self.samples_per_epoch)[:, None] # conditions x samples
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the pending samples, so that the first epoch of every condition starts at the next sample.
+        """
+        self.pending = np.empty((self.channels, 0))
+        self.offset = 0 # Global index of the first pending sample
+        self.epoch_counts = np.zeros(len(self.periods), dtype=int)
+
+    def update(self, block):
+        """
+        Adds a (channels x n) block of samples.
+
+        :return: EpochBatch of the epochs completed by the block, in time order within every condition:
+                 conditions (numpy array of the condition index of every epoch),
+                 epochs (epochs x channels x samples_per_epoch numpy array),
+                 segments (list of the (channels x length) raw samples of every epoch, from floor(k * period) to floor((k + 1) * period),
+                           so that the consecutive segments of a condition cover the stream exactly once)
+        """
+        self.pending = np.concatenate((self.pending, np.asarray(block, dtype=np.float64)), axis=1)
+        available = self.offset + self.pending.shape[1]
+
+        # Epoch k is complete once the sample after its last resampling position has arrived
+        complete = np.ceil((available - 1 - self.grids[:, -1]) / self.periods).astype(int) - self.epoch_counts
+        complete = np.maximum(complete, 0)
+        conditions = np.repeat(np.arange(len(self.periods)), complete)
+        if not conditions.size:
+            return EpochBatch(conditions, np.empty((0, self.pending.shape[0], self.samples_per_epoch)), [])
+
+        # Epoch number of every completed epoch within its condition
+        first_epoch = np.cumsum(complete) - complete
+        epoch_numbers = self.epoch_counts[conditions] + np.arange(conditions.size) - first_epoch[conditions]
+        starts = epoch_numbers * self.periods[conditions]
+        positions = starts[:, None] + self.grids[conditions] - self.offset
+        indices = np.floor(positions).astype(int)
+        fractions = positions - indices
+        epochs = self.pending[:, indices] * (1 - fractions) + self.pending[:, indices + 1] * fractions
+        epochs = np.moveaxis(epochs, 1, 0)
+
+        bounds = np.floor(np.stack((starts, starts + self.periods[conditions]))).astype(int) - self.offset
+        segments = [self.pending[:, start:end] for start, end in bounds.T]
+
+        # The samples before the next epoch of every condition are not needed anymore
+        self.epoch_counts += complete
+        drop = int(np.floor(self.epoch_counts * self.periods).min()) - self.offset
+        self.pending = self.pending[:, drop:]
+        self.offset += drop
+        return EpochBatch(conditions, epochs, segments)
+
+
+def biquad(kind, frequency, sample_freq, q=BUTTERWORTH_Q):
+    """
+    Coefficients of a second-order section from the RBJ audio EQ cookbook, kind being 'lowpass', 'highpass' or 'notch'.
+
+    :return: (b, a) numpy arrays of 3 coefficients each, normalized so that a[0] = 1
+    """
+    w0 = 2 * np.pi * frequency / sample_freq
+    cos_w0 = np.cos(w0)
+    alpha = np.sin(w0) / (2 * q)
+    if kind == 'lowpass':
+        b = [(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2]
+    elif kind == 'highpass':
+        b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    elif kind == 'notch':
+        b = [1, -2 * cos_w0, 1]
+    else:
+        raise ValueError(f"Unknown biquad kind: {kind}")
+    a = np.array([1 + alpha, -2 * cos_w0, 1 - alpha])
+    return np.array(b) / a[0], a / a[0]
+
+
+def ssvep_sections(sample_freq, band=BAND_PASS, notches=(MAINS_FREQ, REFRESH_FREQ), notch_q=NOTCH_Q):
+    """
+    The second-order sections of the SSVEP filter: a band-pass (high-pass then low-pass, None to leave out either edge)
+    and a notch at each of the given frequencies (the ones above the Nyquist frequency are left out).
+
+    :return: list of (b, a) sections
+    """
+    sections = []
+    if band[0] != None:
+        sections.append(biquad('highpass', band[0], sample_freq))
+    if band[1] != None:
+        sections.append(biquad('lowpass', band[1], sample_freq))
+    for frequency in notches:
+        if 0 < frequency < sample_freq / 2:
+            sections.append(biquad('notch', frequency, sample_freq, notch_q))
+    return sections
+
+
+class SOSFilter:
+    def __init__(self, sections, channels=4):
+        """
+        Initialization of the streaming IIR filter, a cascade of second-order sections (b, a) applied to every channel,
+        whose state is carried from one block to the next.
+        The cascade is turned into one state-space system (x' = A x + B u, y = C x + D u, with the transposed direct form II
+        state of every section), so that a block of n samples is filtered for all the channels at once, without a loop over the samples:
+            y = x0 @ O^T + u @ T^T and x_n = x0 @ (A^n)^T + u @ K^T
+        where O (rows C A^k), T (the impulse response Toeplitz matrix) and K (columns A^(n-1-j) B) are computed once per block length.
+        The state starts at the steady state of the first sample, so that the electrode offset does not ring through the filter.
+        """
+        self.A, self.B, self.C, self.D = np.zeros((0, 0)), np.zeros(0), np.zeros(0), 1.0
+        for b, a in sections:
+            A = np.array([[-a[1], 1], [-a[2], 0]])
+            B = np.array([b[1] - a[1] * b[0], b[2] - a[2] * b[0]])
+            C = np.array([1, 0])
+            # The section is fed with the output of the cascade so far
+            order = len(self.B)
+            cascade_A = np.zeros((order + 2, order + 2))
+            cascade_A[:order, :order] = self.A
+            cascade_A[order:, :order] = np.outer(B, self.C)
+            cascade_A[order:, order:] = A
+            self.A = cascade_A
+            self.B = np.concatenate((self.B, B * self.D))
+            self.C = np.concatenate((b[0] * self.C, C))
+            self.D = b[0] * self.D
+        self.channels = channels
+        self.state = None
+        self.block_matrices = {}
+
+    def reset(self):
+        """
+        Clears the filter state, which starts again at the steady state of the next sample.
+        """
+        self.state = None
+
+    def get_block_matrices(self, n):
+        """
+        Returns the (O, T, A^n, K) matrices of a block of n samples (cached per block length).
+        """
+        if n not in self.block_matrices:
+            order = len(self.B)
+            powers = [np.eye(order)]
+            for _ in range(n):
+                powers.append(self.A @ powers[-1])
+            observability = np.array([self.C @ power for power in powers[:n]]).reshape(n, order)
+            impulse_response = np.concatenate(([self.D], [self.C @ power @ self.B for power in powers[:n - 1]]))
+            indices = np.arange(n)
+            lags = indices[:, None] - indices[None, :]
+            toeplitz = np.where(lags >= 0, impulse_response[np.clip(lags, 0, None)], 0)
+            controllability = np.array([power @ self.B for power in powers[n - 1::-1]]).reshape(n, order).T
+            self.block_matrices[n] = (observability, toeplitz, powers[n], controllability)
+        return self.block_matrices[n]
+
+    def update(self, block):
+        """
+        Filters a (channels x n) block of samples.
+
+        :return: (channels x n numpy array) the filtered block
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if self.state is None and block.shape[1]:
+            # Steady state of the first sample: x = (I - A)^-1 B u
+            steady_state = np.linalg.solve(np.eye(len(self.B)) - self.A, self.B)
+            self.state = block[:, :1] * steady_state[None, :]
+        filtered = np.empty_like(block)
+        for start in range(0, block.shape[1], MAX_FILTER_BLOCK):
+            chunk = block[:, start:start + MAX_FILTER_BLOCK]
+            observability, toeplitz, power, controllability = self.get_block_matrices(chunk.shape[1])
+            filtered[:, start:start + chunk.shape[1]] = self.state @ observability.T + chunk @ toeplitz.T
+            self.state = self.state @ power.T + chunk @ controllability.T
+        return filtered
+
+
+@lru_cache(maxsize=None)
+def spectral_window(name, n):
+    """
+    Returns the (read-only) periodic window function of n samples ('hann', 'hamming' or 'boxcar') used by the spectra.
+    """
+    k = np.arange(n)
+    if name == 'hann':
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * k / n)
+    elif name == 'hamming':
+        window = 0.54 - 0.46 * np.cos(2 * np.pi * k / n)
+    elif name == 'boxcar':
+        window = np.ones(n)
+    else:
+        raise ValueError(f"Unknown window: {name}")
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=None)
+def fft_frequencies(nfft, sample_freq):
+    """
+    Returns the (read-only) frequencies of the bins of a real FFT of nfft samples.
+    """
+    frequencies = np.fft.rfftfreq(nfft, d=1. / sample_freq)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+class SpectralEngine:
+    def __init__(self, sample_freq, channels=4, segment=None, overlap=SPECTRUM_OVERLAP, nfft=None, window='hann'):
+        """
+        Initialization of the streaming spectrum engine (short-time Fourier transform and Welch's method).
+        The stream is cut into segments of segment samples (1 second by default) starting every segment * (1 - overlap) samples.
+        Every segment is demeaned, windowed and transformed into a one-sided power spectral density (in unit ** 2 / Hz),
+        for all the channels and all the segments completed by a block in one batched FFT.
+        The Welch estimate is the average of the spectra of all the segments so far.
+        """
+        self.sample_freq = sample_freq
+        self.segment = segment or int(round(sample_freq))
+        self.step = max(int(round(self.segment * (1 - overlap))), 1)
+        self.nfft = nfft or self.segment
+        self.window = spectral_window(window, self.segment)
+        self.frequencies = fft_frequencies(self.nfft, sample_freq)
+        # Density scaling, doubled for the bins that also stand for their negative frequency
+        self.scale = np.full(len(self.frequencies), 2 / (sample_freq * (self.window ** 2).sum()))
+        self.scale[0] /= 2
+        if self.nfft % 2 == 0:
+            self.scale[-1] /= 2
+
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the pending samples and the Welch average, so that the next segment starts at the next sample.
+        """
+        self.pending = np.empty((self.channels, 0))
+        self.psd_sum = np.zeros((self.channels, len(self.frequencies)))
+        self.frame_count = 0
+
+    def update(self, block):
+        """
+        Adds a (channels x n) block of samples.
+
+        :return: (segments x channels x frequencies numpy array) the spectra of the segments completed by the block (spectrogram frames)
+        """
+        self.pending = np.concatenate((self.pending, np.asarray(block, dtype=np.float64)), axis=1)
+        count = (self.pending.shape[1] - self.segment) // self.step + 1 if self.pending.shape[1] >= self.segment else 0
+        if not count:
+            return np.empty((0, self.pending.shape[0], len(self.frequencies)))
+
+        indices = np.arange(count)[:, None] * self.step + np.arange(self.segment)[None, :]
+        segments = self.pending[:, indices] # channels x segments x samples
+        segments = (segments - segments.mean(axis=2, keepdims=True)) * self.window
+        psd = np.abs(np.fft.rfft(segments, n=self.nfft, axis=2)) ** 2 * self.scale
+        psd = np.moveaxis(psd, 1, 0)
+
+        self.psd_sum += psd.sum(axis=0)
+        self.frame_count += count
+        self.pending = self.pending[:, count * self.step:]
+        return psd
+
+    def welch(self):
+        """
+        :return: (channels x frequencies numpy array) Welch power spectral density, i.e. the average spectrum of the segments so far
+                 (None before the first complete segment)
+        """
+        return self.psd_sum / self.frame_count if self.frame_count else None
+
+
+def exact_bin_segment(frequencies, sample_freq, min_length, max_length, tolerance=1e-6):
+    """
+    Returns the shortest segment length (in samples) between min_length and max_length whose FFT bins fall exactly on all the
+    frequencies (and so on their harmonics), so that their power does not leak into the neighbouring bins (min_length if there is none).
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    for n in range(int(min_length), int(max_length) + 1):
+        bins = frequencies * n / sample_freq
+        if np.all(np.abs(bins - np.round(bins)) < tolerance):
+            return n
+    return int(min_length)
+
+
+def welch(data, sample_freq, segment=None, overlap=SPECTRUM_OVERLAP, nfft=None, window='hann'):
+    """
+    Welch power spectral density of a whole (channels x n) recording (see SpectralEngine).
+
+    :return: (frequencies, channels x frequencies numpy array), the PSD being None if the recording is shorter than a segment
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    engine = SpectralEngine(sample_freq, data.shape[0], segment, overlap, nfft, window)
+    engine.update(data)
+    return engine.frequencies, engine.welch()
@@ -0,0 +1,136 @@
+import os
+from time import perf_counter
+import numpy as np
+
+# Initializations of some static variables:
+FPS = 60
+MISSED_FRAME_FACTOR = 1.5 # A frame interval longer than this many nominal frames means that at least one refresh was missed
+FRAME_TIMING_LOG = "../logs/frame_timing.log"
+REFRESH_PROBE_FRAMES = 120 # Flips timed to measure the refresh rate
+REFRESH_RATE_RANGE = (20, 500) # Hz, a measured rate outside of it means that the flips are not synchronized to the refresh (no vsync)
+FLICKER_FREQ_RANGE = (6, 30) # Hz, the flicker frequencies that are planned
+
+
+def measure_refresh_rate(flip, frames=REFRESH_PROBE_FRAMES):
+    """
+    Measures the refresh rate of the display from the median interval of consecutive flips (which wait for the vertical sync).
+
+    :return: refresh rate in Hz (None if the flips do not wait for the vertical sync)
+    """
+    timestamps = []
+    for _ in range(frames + 1):
+        flip()
+        timestamps.append(perf_counter())
+    rate = 1 / np.median(np.diff(timestamps))
+    return rate if REFRESH_RATE_RANGE[0] <= rate <= REFRESH_RATE_RANGE[1] else None
+
+
+def achievable_flicker_frequencies(refresh_rate, frequency_range=FLICKER_FREQ_RANGE):
+    """
+    The flicker frequencies that can be shown exactly at a refresh rate: refresh rate / period, the period being a whole number
+    of frames (at least 2, one frame on and one off), together with the possible numbers of on frames per period.
+
+    :return: list of (frequency, period, on frame counts) tuples, from the highest frequency to the lowest
+    """
+    plan = []
+    for period in range(2, int(refresh_rate / frequency_range[0]) + 1):
+        frequency = refresh_rate / period
+        if frequency_range[0] <= frequency <= frequency_range[1]:
+            plan.append((frequency, period, tuple(range(1, period))))
+    return plan
+
+
+def flicker_period(refresh_rate, frequency):
+    """
+    :return: the period (in frames) of the achievable flicker frequency closest to frequency
+    """
+    return max(int(round(refresh_rate / frequency)), 2)
+
+
+def read_logged_refresh_rate(file_name=FRAME_TIMING_LOG):
+    """
+    :return: the frame rate the last flicker test ran at (from its frame timing report), None if there is no report
+    """
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        split_line = f.readline().split()
+    return float(split_line[3]) if len(split_line) > 3 and split_line[:3] == ['Nominal', 'frame', 'rate:'] else None
+
+
+class FrameTimer:
+    def __init__(self, fps=FPS, missed_frame_factor=MISSED_FRAME_FACTOR):
+        """
+        Initialization of the frame timer of the flicker stimulus.
+        Every flip (display update) of a test is timestamped right before and right after it with the high-resolution clock,
+        so that the realized frame rate, the missed frames and the jitter of every test can be reported,
+        and with them the flicker frequency that was actually shown (the flicker period being counted in frames).
+        """
+        self.fps = fps
+        self.frame_time = 1 / fps
+        self.missed_frame_factor = missed_frame_factor
+        self.flips = dict() # test -> list of (before flip, after flip) timestamps
+        self.tests = [] # Tests in the order they were shown
+
+    def flip(self, update, test=None):
+        """
+        Calls update() (e.g. pygame.display.update) and records its timestamps under test (frames outside of tests, i.e. test None, are not recorded).
+        """
+        before = perf_counter()
+        update()
+        after = perf_counter()
+        if test is None:
+            return
+        if test not in self.flips:
+            self.flips[test] = []
+            self.tests.append(test)
+        self.flips[test].append((before, after))
+
+    def test_stats(self, test, periods=None):
+        """
+        Statistics of the frames of a test: frames, duration, realized frame rate, missed frames, interval jitter,
+        longest interval and flip duration (in seconds), and for every flicker period of periods (name -> frames per flicker cycle)
+        the nominal and realized flicker frequency and the jitter of the flicker cycle duration.
+
+        :return: dict (None if the test has less than 2 frames)
+        """
+        flips = np.array(self.flips.get(test, []))
+        if len(flips) < 2:
+            return None
+        timestamps = flips[:, 1]
+        intervals = np.diff(timestamps)
+        duration = timestamps[-1] - timestamps[0]
+        late = intervals > self.missed_frame_factor * self.frame_time
+        stats = {'frames': len(timestamps), 'duration': duration, 'realized_fps': len(intervals) / duration,
+                 'missed_frames': int(np.round(intervals[late] / self.frame_time).sum() - late.sum()),
+                 'jitter': intervals.std(), 'max_interval': intervals.max(), 'max_flip': (flips[:, 1] - flips[:, 0]).max(),
+                 'flicker': dict()}
+
+        for name, period in (periods or dict()).items():
+            cycles = np.diff(timestamps[::period])
+            stats['flicker'][name] = {'nominal_frequency': self.fps / period,
+                                      'realized_frequency': stats['realized_fps'] / period,
+                                      'cycle_jitter': cycles.std() if len(cycles) else 0.0}
+        return stats
+
+    def write_report(self, periods=None, file_name=FRAME_TIMING_LOG):
+        """
+        Writes the frame timing and flicker frequency accuracy of every test to file_name.
+        """
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'w') as f:
+            f.write(f"Nominal frame rate: {self.fps:g} FPS ({self.frame_time * 1e3:.2f} ms per frame)\n\n")
+            for test in self.tests:
+                stats = self.test_stats(test, periods)
+                if stats is None:
+                    continue
+                f.write(f"Test {test}:\n"
+                        + f"\tframes: {stats['frames']} in {stats['duration']:.2f} s\n"
+                        + f"\trealized frame rate: {stats['realized_fps']:.3f} FPS\n"
+                        + f"\tmissed frames: {stats['missed_frames']}\n"
+                        + f"\tframe interval jitter: {stats['jitter'] * 1e3:.3f} ms (longest interval: {stats['max_interval'] * 1e3:.2f} ms)\n"
+                        + f"\tlongest flip: {stats['max_flip'] * 1e3:.2f} ms\n")
+                for name, flicker in stats['flicker'].items():
+                    f.write(f"\t{name} flicker: {flicker['realized_frequency']:.3f} Hz realized "
+                            + f"({flicker['nominal_frequency']:.3f} Hz nominal), cycle jitter: {flicker['cycle_jitter'] * 1e3:.3f} ms\n")
+                f.write("\n")
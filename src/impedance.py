@@ -0,0 +1,85 @@
+import numpy as np
+from ring_buffer import RingBuffer
+from dsp import RunningSums
+
+# Initializations of some static variables:
+RESIST_WINDOW = 16 # resistance readings kept per electrode
+BAD_CONTACT_RESISTANCE = 2 * (10 ** 6) # Ohm, above this the electrode contact is considered bad
+RESIST_CEILING = 10 ** 9 # Ohm, infinite (open circuit) or missing readings are stored as this value
+
+
+class ResistMonitor:
+    def __init__(self, channels=4, window=RESIST_WINDOW, threshold=BAD_CONTACT_RESISTANCE):
+        """
+        Initialization of the rolling resistance (impedance) tracker of the electrodes.
+        The last window readings of every electrode are kept in a ring buffer, next to their running sum and sum of squares,
+        so that the mean and standard deviation of the window are updated in O(1) per reading.
+        An electrode's contact is good while its mean resistance over the window stays below the threshold.
+        """
+        self.buffer = RingBuffer(channels, window)
+        self.threshold = threshold
+        self.sum = np.zeros(channels)
+        self.sum_sq = np.zeros(channels)
+        self.running_sums = RunningSums(window, self.refresh)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def update(self, resistance):
+        """
+        Adds one reading (one resistance value per electrode, in Ohm) to the window.
+        """
+        sample = np.minimum(np.nan_to_num(np.asarray(resistance, dtype=np.float64), nan=RESIST_CEILING, posinf=RESIST_CEILING), RESIST_CEILING)
+        if len(self.buffer) == self.buffer.capacity:
+            # The oldest reading leaves the window
+            oldest = self.buffer.tail()[:, 0]
+            self.sum -= oldest
+            self.sum_sq -= oldest ** 2
+        self.buffer.append(sample)
+        self.sum += sample
+        self.sum_sq += sample ** 2
+        self.running_sums.advance(1)
+
+    def refresh(self):
+        """
+        Recomputes the sums from the readings in the window.
+        """
+        window = self.buffer.tail()
+        self.sum = window.sum(axis=1)
+        self.sum_sq = (window ** 2).sum(axis=1)
+
+    def last(self):
+        """
+        :return: last reading of every electrode (numpy array, None if no reading was received yet)
+        """
+        return self.buffer.tail(1)[:, 0].copy() if len(self.buffer) else None
+
+    def mean(self):
+        """
+        :return: mean resistance of every electrode over the window (numpy array, None if no reading was received yet)
+        """
+        return self.sum / len(self.buffer) if len(self.buffer) else None
+
+    def std(self):
+        """
+        :return: standard deviation of the resistance of every electrode over the window (numpy array, None if no reading was received yet)
+        """
+        if not len(self.buffer):
+            return None
+        mean = self.sum / len(self.buffer)
+        return np.sqrt(np.maximum(self.sum_sq / len(self.buffer) - mean ** 2, 0))
+
+    def contact_quality(self):
+        """
+        :return: boolean numpy array, True for the electrodes with a good contact (all of them while no reading was received)
+        """
+        if not len(self.buffer):
+            return np.ones(self.buffer.channels, dtype=bool)
+        return self.mean() < self.threshold
+
+    def is_good(self, channels=None):
+        """
+        Returns True if the contact of all the given electrodes (indices, all of them if None) is good.
+        """
+        quality = self.contact_quality()
+        return bool(quality.all() if channels is None else quality[list(channels)].all())
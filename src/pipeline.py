@@ -0,0 +1,436 @@
+import sys
+import queue
+import threading
+from time import perf_counter, sleep
+import numpy as np
+from ring_buffer import RingBuffer
+from dsp import SOSFilter, StreamingDetrender, EpochEngine, SpectralEngine, ssvep_sections, MAINS_FREQ, REFRESH_FREQ
+from ssvep import GoertzelBank, CCAClassifier, SSVEP_WINDOW, SAMPLE_FREQ
+from sensor_backends import load_recording
+
+# Initializations of some static variables:
+QUEUE_SIZE = 16 # packets waiting between two stages, a full queue blocks the stage before it
+RECORDING_BLOCK = 25 # samples per packet when reading a recording (100 ms at 250 Hz)
+POLL_INTERVAL = 0.004 # seconds the source waits when the sensor has no new samples
+QUEUE_TIMEOUT = 0.1 # seconds, how often the stage threads check that the pipeline was not stopped
+
+
+class Stage:
+    def __init__(self, name):
+        """
+        Base of the pipeline stages. A stage processes packets, i.e. dicts holding the (channels x n) 'samples' block
+        and what the stages before it added (e.g. 'filtered', 'batch', 'features'), and returns the packet
+        (None to drop it, in which case the following stages do not see it).
+        Every stage counts its calls, the samples that went through it and the time spent processing them.
+        """
+        self.name = name
+        self.calls = 0
+        self.samples = 0
+        self.busy_time = 0.0
+        self.max_latency = 0.0
+
+    def process(self, packet):
+        raise NotImplementedError
+
+    def reset(self):
+        """
+        Clears what the stage carries from one packet to the next (its counters are kept). Nothing by default.
+        """
+        pass
+
+    def __call__(self, packet):
+        start = perf_counter()
+        packet = self.process(packet)
+        elapsed = perf_counter() - start
+
+        self.calls += 1
+        self.busy_time += elapsed
+        self.max_latency = max(self.max_latency, elapsed)
+        if packet != None:
+            self.samples += packet['samples'].shape[1]
+        return packet
+
+    def stats(self):
+        """
+        :return: dict of the counters of the stage: calls, samples, busy time and mean / max latency per call (in seconds),
+                 and throughput (samples per busy second)
+        """
+        return {'calls': self.calls, 'samples': self.samples, 'busy_time': self.busy_time,
+                'mean_latency': self.busy_time / self.calls if self.calls else 0.0, 'max_latency': self.max_latency,
+                'throughput': self.samples / self.busy_time if self.busy_time > 0 else 0.0}
+
+
+class SensorSource(Stage):
+    def __init__(self, sensor, name='sensor'):
+        """
+        Source of the samples received by a Sensor (or ProcessSensor) from the time of the first read on.
+        Every read returns the samples received since the previous one, or None if there are none.
+        """
+        super().__init__(name)
+        self.sensor = sensor
+        self.cursor = None
+        self.finished = False # A sensor stream does not end
+
+    def process(self, packet):
+        if self.cursor is None:
+            self.cursor = self.sensor.get_sample_count()
+        start = self.cursor
+        samples, self.cursor = self.sensor.read_since(self.cursor)
+        if not samples.shape[1]:
+            return None
+        return {'samples': samples, 'start': start, 'created': perf_counter()}
+
+    def reset(self):
+        """
+        Skips the samples received so far, the next read starts from the next sample.
+        """
+        self.cursor = self.sensor.get_sample_count()
+
+
+class RecordingSource(Stage):
+    def __init__(self, paths, block_size=RECORDING_BLOCK, name='recording'):
+        """
+        Source of the samples of flicker test recordings (see load_recording), in blocks of block_size samples.
+        """
+        super().__init__(name)
+        self.data, sample_freq = load_recording(paths)
+        self.sample_freq = sample_freq or SAMPLE_FREQ
+        self.block_size = block_size
+        self.cursor = 0
+        self.finished = not self.data.shape[1]
+
+    def process(self, packet):
+        start = self.cursor
+        self.cursor = min(start + self.block_size, self.data.shape[1])
+        self.finished = self.cursor == self.data.shape[1]
+        return {'samples': self.data[:, start:self.cursor], 'start': start, 'created': perf_counter()}
+
+
+class FunctionStage(Stage):
+    def __init__(self, name, function):
+        """
+        Stage calling function(packet), which returns the packet (or None to drop it).
+        """
+        super().__init__(name)
+        self.function = function
+
+    def process(self, packet):
+        return self.function(packet)
+
+
+class FilterStage(Stage):
+    def __init__(self, sections, channels=4, source='samples', target='filtered', name='filter'):
+        """
+        Stage applying a streaming IIR filter (see SOSFilter) to the source block of the packet.
+        """
+        super().__init__(name)
+        self.filter = SOSFilter(sections, channels)
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        packet[self.target] = self.filter.update(packet[self.source])
+        return packet
+
+    def reset(self):
+        self.filter.reset()
+
+
+class DetrendStage(Stage):
+    def __init__(self, window, channels=4, source='samples', target='detrended', name='detrend'):
+        """
+        Stage removing the linear drift of the last window samples from the source block (see StreamingDetrender).
+        """
+        super().__init__(name)
+        self.detrender = StreamingDetrender(channels, window)
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        packet[self.target] = self.detrender.update(packet[self.source])
+        return packet
+
+    def reset(self):
+        self.detrender.reset()
+
+
+class PowerStage(Stage):
+    def __init__(self, frequencies, channels=4, sample_freq=SAMPLE_FREQ, source='filtered', target='power', name='power'):
+        """
+        Stage tracking the SSVEP power at the stimulus frequencies (see GoertzelBank); the packet gets the power after its last sample.
+        """
+        super().__init__(name)
+        self.bank = GoertzelBank(frequencies, channels, sample_freq)
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        self.bank.update(packet[self.source])
+        packet[self.target] = self.bank.ssvep_power()
+        return packet
+
+    def reset(self):
+        self.bank.reset()
+
+
+class SpectrumStage(Stage):
+    def __init__(self, sample_freq=SAMPLE_FREQ, channels=4, source='filtered', target='spectra', name='spectrum', **spectrum_options):
+        """
+        Stage computing the spectra of the overlapping segments completed by the packet (see SpectralEngine):
+        the packet gets the (segments x channels x frequencies) spectrogram frames, and the engine keeps the Welch average.
+        """
+        super().__init__(name)
+        self.engine = SpectralEngine(sample_freq, channels, **spectrum_options)
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        packet[self.target] = self.engine.update(packet[self.source])
+        return packet
+
+    def reset(self):
+        self.engine.reset()
+
+
+class EpochStage(Stage):
+    def __init__(self, periods, channels=4, sources=('filtered', 'samples'), target='batch', name='epoch'):
+        """
+        Stage cutting the stream into stimulus periods (see EpochEngine). The source blocks are stacked over each other
+        (channels rows each), so that the epochs of all of them are cut at the same positions.
+        """
+        super().__init__(name)
+        self.engine = EpochEngine(periods, channels * len(sources))
+        self.sources = sources
+        self.target = target
+
+    def process(self, packet):
+        packet[self.target] = self.engine.update(np.concatenate([packet[source] for source in self.sources]))
+        return packet
+
+    def reset(self):
+        self.engine.reset()
+
+
+class FeatureStage(Stage):
+    def __init__(self, channels=slice(0, 4), source='batch', target='features', name='features'):
+        """
+        Stage reducing every epoch of the batch to the min-max difference of the given channels (epochs x channels).
+        """
+        super().__init__(name)
+        self.channels = channels
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        epochs = packet[self.source].epochs[:, self.channels]
+        packet[self.target] = epochs.max(axis=2) - epochs.min(axis=2)
+        return packet
+
+
+class ClassifierStage(Stage):
+    def __init__(self, frequencies, channels=4, sample_freq=SAMPLE_FREQ, window=SSVEP_WINDOW, source='filtered',
+                       target='classification', name='classifier'):
+        """
+        Stage classifying the last window samples (see CCAClassifier) once per packet, as soon as window samples were received.
+        The packet gets the (frequency, scores) decision, or None while the window is not full.
+        """
+        super().__init__(name)
+        self.classifier = CCAClassifier(frequencies, sample_freq)
+        self.window = RingBuffer(channels, window)
+        self.source = source
+        self.target = target
+
+    def process(self, packet):
+        self.window.extend(packet[self.source])
+        full = len(self.window) == self.window.capacity
+        packet[self.target] = self.classifier.classify(self.window.tail()) if full else None
+        return packet
+
+    def reset(self):
+        self.window = RingBuffer(self.window.channels, self.window.capacity)
+
+
+class Pipeline:
+    def __init__(self, source, stages, queue_size=QUEUE_SIZE):
+        """
+        Initialization of a streaming pipeline: the packets read from the source go through the stages in order.
+        The pipeline can either be stepped from the caller's loop (step / run), or run with one thread per stage (start / stop),
+        the stages being connected by bounded queues (a slow stage blocks the ones before it instead of piling up packets).
+        The end-to-end latency (from the read of the packet to the end of the last stage) is tracked next to the stage counters.
+        """
+        self.source = source
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.packets = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.queues = []
+
+    def get_stage(self, name):
+        for stage in [self.source] + self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def run_stages(self, packet, stages):
+        for stage in stages:
+            packet = stage(packet)
+            if packet is None:
+                return None
+        return packet
+
+    def done(self, packet):
+        latency = perf_counter() - packet['created']
+        self.packets += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def step(self):
+        """
+        Reads the source once and runs the packet through all the stages, in the caller's thread.
+
+        :return: the processed packet (None if the source had nothing new or a stage dropped it)
+        """
+        packet = self.source(None)
+        if packet != None:
+            packet = self.run_stages(packet, self.stages)
+            if packet != None:
+                self.done(packet)
+        return packet
+
+    def reset(self):
+        """
+        Resets the source and every stage, so that the pipeline starts over from the next sample of the source, as if it was new
+        (e.g. at the start of a flicker test, instead of going on from the samples and the filter states of the previous one).
+        Only to be called between two steps, not while the stage threads are running.
+        """
+        for stage in [self.source] + self.stages:
+            stage.reset()
+
+    def run(self):
+        """
+        Steps the pipeline until the source is finished (e.g. the end of a recording).
+        """
+        while not self.source.finished:
+            self.step()
+
+    def start(self):
+        """
+        Runs the source and every stage in its own thread.
+        """
+        self.stop_event.clear()
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self.threads = [threading.Thread(target=self.source_loop, daemon=True)]
+        for i in range(len(self.stages)):
+            self.threads.append(threading.Thread(target=self.stage_loop, args=(i,), daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the threads (the packets still queued are dropped).
+        """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def put(self, q, packet):
+        while not self.stop_event.is_set():
+            try:
+                q.put(packet, timeout=QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def source_loop(self):
+        while not self.stop_event.is_set() and not self.source.finished:
+            packet = self.source(None)
+            if packet is None:
+                sleep(POLL_INTERVAL)
+            elif self.stages:
+                self.put(self.queues[0], packet)
+            else:
+                self.done(packet)
+
+    def stage_loop(self, i):
+        while not self.stop_event.is_set():
+            try:
+                packet = self.queues[i].get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            packet = self.stages[i](packet)
+            if packet is None:
+                continue
+            if i + 1 < len(self.stages):
+                self.put(self.queues[i + 1], packet)
+            else:
+                self.done(packet)
+
+    def stats(self):
+        """
+        :return: dict (stage name -> stage counters, see Stage.stats), plus the 'pipeline' entry with the processed packets
+                 and their mean / max end-to-end latency
+        """
+        stats = {stage.name: stage.stats() for stage in [self.source] + self.stages}
+        stats['pipeline'] = {'packets': self.packets, 'max_latency': self.max_latency,
+                             'mean_latency': self.total_latency / self.packets if self.packets else 0.0}
+        return stats
+
+    def print_stats(self, file=None):
+        stats = self.stats()
+        print(f"{'Stage':<12}{'Calls':>8}{'Samples':>10}{'Busy [ms]':>11}{'Mean [us]':>11}{'Max [us]':>10}{'Throughput [samples/s]':>24}", file=file)
+        for stage in [self.source] + self.stages:
+            s = stats[stage.name]
+            print(f"{stage.name:<12}{s['calls']:>8}{s['samples']:>10}{s['busy_time'] * 1e3:>11.1f}{s['mean_latency'] * 1e6:>11.1f}"
+                  f"{s['max_latency'] * 1e6:>10.1f}{s['throughput']:>24.0f}", file=file)
+        s = stats['pipeline']
+        print(f"{s['packets']} packets, end-to-end latency: mean {s['mean_latency'] * 1e3:.2f} ms, max {s['max_latency'] * 1e3:.2f} ms", file=file)
+
+
+def ssvep_stages(frequencies, epoch_frequencies=None, sample_freq=SAMPLE_FREQ, notches=(MAINS_FREQ, REFRESH_FREQ), spectrum_segment=None):
+    """
+    The stages of the SSVEP detection of the flicker test, shared by the game and the offline analysis:
+    filter (band-pass and notches) -> SSVEP power -> spectra -> CCA classifier -> epochs of the stimulus periods -> min-max features.
+    epoch_frequencies are the frequencies the stream is epoched at (the stimulus frequencies by default),
+    spectrum_segment the length of the spectrum segments (1 second by default).
+    """
+    epoch_frequencies = frequencies if epoch_frequencies is None else epoch_frequencies
+    return [FilterStage(ssvep_sections(sample_freq, notches=notches)),
+            PowerStage(frequencies, sample_freq=sample_freq),
+            SpectrumStage(sample_freq, segment=spectrum_segment),
+            ClassifierStage(frequencies, sample_freq=sample_freq),
+            EpochStage([sample_freq / frequency for frequency in epoch_frequencies]),
+            FeatureStage()]
+
+
+if __name__ == "__main__":
+    # Command format is: python3 ./pipeline.py <stimulus frequencies, e.g. 20,12> <recording files or directories>
+    error_msg = "Command format is: python3 ./pipeline.py <stimulus frequencies, e.g. 20,12> <recording files or directories>"
+    args = sys.argv[1:]
+    if len(args) < 2:
+        sys.exit(error_msg)
+    frequencies = [float(f) for f in args[0].split(',')]
+
+    source = RecordingSource(args[1:])
+    decisions = dict()
+
+    def count_decision(packet):
+        if packet['classification'] != None:
+            frequency = packet['classification'][0]
+            decisions[frequency] = decisions.get(frequency, 0) + 1
+        return packet
+
+    pipeline = Pipeline(source, ssvep_stages(frequencies, sample_freq=source.sample_freq) + [FunctionStage('decisions', count_decision)])
+    pipeline.run()
+    pipeline.print_stats()
+    spectrum = pipeline.get_stage('spectrum').engine
+    psd = spectrum.welch()
+    if psd is not None:
+        bins = [int(np.argmin(np.abs(spectrum.frequencies - frequency))) for frequency in frequencies]
+        for channel, name in enumerate(('O1', 'O2', 'T3', 'T4')):
+            print(f"Welch PSD of {name} at " + ", ".join(f"{frequencies[i]} Hz: {psd[channel, b]:.2e}" for i, b in enumerate(bins)))
+    for frequency, count in sorted(decisions.items(), key=lambda item: -item[1]):
+        print(f"{frequency if frequency != None else 'indeterminate'}: {count} windows")
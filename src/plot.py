@@ -1,25 +1,11 @@
 import sys
-import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression
+from dsp import detrend
 
 SSVEP_THRESHOLD = 10 ** -5
 
 def linearly_regress_plot_data(amps):
-    amps = list(map(float, amps))
-    no_of_data_points = len(amps)
-    xs_flicker = np.arange(0, no_of_data_points).tolist()
-    
-    reg = LinearRegression(fit_intercept=True)
-    reg.fit(np.array(xs_flicker).reshape(-1,1), np.array(amps))
-
-    for t in range(no_of_data_points):
-        amps_drift = reg.coef_[0] * (no_of_data_points - t)
-        # print(f"amps[{t}]: {amps[t]}")
-        amps[t] = amps[t] + amps_drift - reg.intercept_
-        # print(f"regressed amps[{t}]: {amps[t]}")
-
-    return list(map(str, amps))
+    return list(map(str, detrend(list(map(float, amps)))))
 
 def proportions_for_each_element(l):
     s = set(l)
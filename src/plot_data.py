@@ -1,9 +1,11 @@
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
+from dsp import welch
+from frame_timing import read_logged_refresh_rate
 
 # SAMPLE_FREQ = 250 # Hz, the BrainBit's fequency
-REFRESH_FREQ = 60 # Hz, the screen refresh rate
+REFRESH_FREQ = read_logged_refresh_rate() or 60 # Hz, the screen refresh rate (the one of the last flicker test, if it was logged)
 
 def to_freq_plot(amps, sample_freq, hemisphere):
     amps = np.array(amps)
@@ -51,18 +53,39 @@ def to_freq_plot(amps, sample_freq, hemisphere):
     return freq, freq_amps, freq_of_interest_amps_avg, freq_full, freq_amps_full
 
 
+def to_welch_plot(amps, sample_freq, hemisphere):
+    # Welch PSD of the whole recording (average of the spectra of overlapping 1 second segments)
+    freq, psd = welch(amps, sample_freq)
+    if psd is None:
+        sys.exit(f"The recording of {hemisphere} is shorter than a spectrum segment")
+    psd = psd[0]
+
+    # Eliminating the 0th component and the component corresponding to the monitor refresh rate (i.e. the one closest to 60Hz)
+    freq, psd = freq[1:], psd[1:]
+    refresh_rate_idx = np.argmin(np.abs(freq - REFRESH_FREQ))
+    freq_of_interest_psd_avg = np.average(np.delete(psd, refresh_rate_idx))
+
+    print(f"Average PSD of the frequencies of interest for {hemisphere}: {freq_of_interest_psd_avg:.2e}\n")
+
+    return freq, psd, freq_of_interest_psd_avg
+
+
 # Command parsing
 
 args = sys.argv[1:]
 no_args_min = 3
 next_arg_idx = 0
-error_msg = "Command format is: python3 ./plot_data.py [plot type: freq/amp] <save> <plot_name> [files_to_plot_from]"
+error_msg = "Command format is: python3 ./plot_data.py [plot type: freq/welch/amp] <save> <plot_name> [files_to_plot_from]"
 
 if len(args) < no_args_min:
     sys.exit(error_msg)
 
+WELCH_PLOT = False
 if args[next_arg_idx] == 'freq':
     FREQ_PLOT = True
+elif args[next_arg_idx] == 'welch':
+    FREQ_PLOT = True
+    WELCH_PLOT = True
 elif args[next_arg_idx] == 'amp':
     FREQ_PLOT = False
 else:
@@ -99,7 +122,7 @@ if FREQ_PLOT:
     if not PLOT_NAME:
         PLOT_NAME = "Frequency plot"
     ax.set_xlabel("Frequency bins")
-    ax.set_ylabel("Frequency amplitude")
+    ax.set_ylabel("Power spectral density" if WELCH_PLOT else "Frequency amplitude")
 else:
     if not PLOT_NAME:
         PLOT_NAME = "Batch average"
@@ -172,7 +195,18 @@ for file_path in args[next_arg_idx:]:
                 amps_line.append(split_lines[j][i])
             amps_avgs.append(np.average(amps_line))
 
-    if FREQ_PLOT and sample_freq:
+    if WELCH_PLOT and sample_freq:
+        # The whole stream (the flicker periods one after the other), instead of the average flicker period
+        freq, psd, freq_of_interest_psd = to_welch_plot([e for l in split_lines for e in l], sample_freq, hemisphere)
+
+        plt.semilogy(freq, psd, stem_colors[curr_color_idx], label=hemisphere)
+
+        curr_color_idx += 1
+        if curr_color_idx == len(stem_colors):
+            curr_color_idx = 0
+
+        freq_of_interest_avgs.append(freq_of_interest_psd)
+    elif FREQ_PLOT and sample_freq:
         freq, freq_amps, freq_of_interest_amps, freq_full, freq_amps_full = to_freq_plot(amps_avgs, sample_freq, hemisphere)
         
         plt.stem(freq, freq_amps, stem_colors[curr_color_idx], label=hemisphere)
@@ -0,0 +1,216 @@
+import multiprocessing
+import threading
+import numpy as np
+from ring_buffer import SharedRingBuffer
+from sensor import Sensor, BUFFER_LENGTH, create_buffers
+
+# Initializations of some static variables:
+STATUS_INTERVAL = 0.5 # seconds between two refreshes of the connection status by the acquisition process
+PUMP_INTERVAL = 0.004 # seconds between two polls of the shared buffers for the listeners (about one BrainBit packet)
+JOIN_TIMEOUT = 5
+
+
+def acquisition_process(backend_factory, gap_fill, buffer_specs, connection, connected, contact_quality):
+    """
+    Entry point of the acquisition process.
+    Runs a Sensor writing into the shared buffers, and executes the commands received from the ProcessSensor until told to quit.
+    """
+    buffers = tuple(SharedRingBuffer(*spec) for spec in buffer_specs)
+    sensor = Sensor(backend_factory() if backend_factory != None else None, gap_fill=gap_fill, buffers=buffers)
+    commands = {'activate': sensor.activate_sensor,
+                'deactivate': sensor.deactivate_sensor,
+                'start': sensor.start_streaming,
+                'stop': sensor.stop_streaming,
+                'set_recording': sensor.set_recording,
+                'set_stimulus_frequencies': sensor.set_stimulus_frequencies,
+                'print_information': sensor.print_sensor_information,
+                'stats': sensor.get_acquisition_stats}
+
+    while True:
+        try:
+            if connection.poll(STATUS_INTERVAL):
+                command, args = connection.recv()
+                if command == 'quit':
+                    break
+                try:
+                    result = commands[command](*args)
+                except Exception as err:
+                    result = err
+                # The status is published before the result, so that it is up to date once the command returns
+                publish_status(sensor, connected, contact_quality)
+                connection.send(result)
+            else:
+                publish_status(sensor, connected, contact_quality)
+        except (EOFError, OSError):
+            break # The game process is gone
+
+    if sensor.is_connected():
+        sensor.deactivate_sensor()
+    for buffer in buffers:
+        buffer.close()
+
+
+def publish_status(sensor, connected, contact_quality):
+    """
+    Publishes the connection status and the electrode contact quality of the sensor into the shared values.
+    """
+    connected.value = sensor.is_connected()
+    contact_quality[:] = sensor.get_contact_quality()
+
+
+class ProcessSensor:
+    def __init__(self, backend_factory=None, buffer_length=BUFFER_LENGTH, dtype=np.float64, gap_fill=None):
+        """
+        Initialization of a sensor whose acquisition runs in a separate process, so that the signal callbacks
+        and the game's rendering do not compete for the same interpreter (and its GIL).
+        The acquisition process writes into ring buffers in shared memory, which are read here without copying,
+        and receives the commands (connect, start, stop, ...) through a pipe.
+        It has the same interface as Sensor. Since the backend is created in the acquisition process,
+        it is given as a picklable backend_factory (a backend class, or a functools.partial of one; None for the BrainBit).
+        """
+        self.data_buffer, self.timestamp_buffer, self.packnum_buffer = create_buffers(SharedRingBuffer, buffer_length, dtype)
+        self.threading_event = threading.Event()
+        self.command_lock = threading.Lock()
+        self.listeners = []
+        self.pump_thread = None
+        self.pump_stop = threading.Event()
+
+        # Spawned rather than forked, so that the acquisition process does not inherit pygame's state
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.connected = context.Value('b', False, lock=False)
+        self.contact_quality = context.Array('b', [True] * self.data_buffer.channels, lock=False)
+        buffer_specs = [buffer.spec() for buffer in (self.data_buffer, self.timestamp_buffer, self.packnum_buffer)]
+        self.process = context.Process(target=acquisition_process,
+                                       args=(backend_factory, gap_fill, buffer_specs, child_connection, self.connected, self.contact_quality),
+                                       daemon=True)
+        self.process.start()
+
+    # The reading methods only use the buffers, so they are the Sensor ones
+    get_data = Sensor.get_data
+    get_timestamps = Sensor.get_timestamps
+    get_sample_count = Sensor.get_sample_count
+    read_since = Sensor.read_since
+
+    def add_listener(self, listener):
+        """
+        Registers a listener, called as listener(block, timestamps) with every block of new samples.
+        The listeners run in this process, on a thread polling the shared buffers every PUMP_INTERVAL seconds.
+        """
+        self.listeners.append(listener)
+        if self.pump_thread == None:
+            self.pump_thread = threading.Thread(target=self.pump, daemon=True)
+            self.pump_thread.start()
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def pump(self):
+        """
+        Hands the samples written into the shared buffers by the acquisition process over to the listeners.
+        """
+        cursor = self.get_sample_count()
+        while not self.pump_stop.wait(PUMP_INTERVAL):
+            if self.get_sample_count() == cursor:
+                continue
+            start = cursor
+            block, cursor = self.data_buffer.read_since(cursor)
+            # The timestamps of the same samples (the data buffer is written last, so they are available)
+            timestamps, _ = self.timestamp_buffer.read_since(cursor - block.shape[1], cursor)
+            if cursor - start > block.shape[1]:
+                print(f"The listeners fell behind, {cursor - start - block.shape[1]} samples were skipped")
+            for listener in self.listeners:
+                listener(block, timestamps[0])
+
+    def send_command(self, command, *args):
+        """
+        Sends a command to the acquisition process and waits for its result.
+        Exceptions raised in the acquisition process are raised again here.
+        """
+        with self.command_lock:
+            self.connection.send((command, args))
+            result = self.connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def activate_sensor(self):
+        """
+        Connects the acquisition process to its data source.
+        """
+        self.send_command('activate')
+
+    def deactivate_sensor(self):
+        """
+        Disconnects from the data source, stops the acquisition process and frees the shared buffers.
+        """
+        if self.pump_thread != None:
+            self.pump_stop.set()
+            self.pump_thread.join()
+            self.pump_thread = None
+        if self.process.is_alive():
+            self.send_command('deactivate')
+            with self.command_lock:
+                self.connection.send(('quit', ()))
+            self.process.join(JOIN_TIMEOUT)
+        for buffer in (self.data_buffer, self.timestamp_buffer, self.packnum_buffer):
+            buffer.close()
+
+    def is_connected(self):
+        """
+        Returns the connection status last published by the acquisition process, without waiting for it.
+        """
+        return bool(self.connected.value)
+
+    def get_contact_quality(self):
+        """
+        Returns the electrode contact quality last published by the acquisition process, without waiting for it.
+
+        :return: (O1, O2, T3, T4) tuple of booleans
+        """
+        return tuple(bool(good) for good in self.contact_quality)
+
+    def is_contact_good(self, channels=None):
+        quality = self.get_contact_quality()
+        return all(quality[channel] for channel in (channels if channels != None else range(len(quality))))
+
+    def read_sensor_1s(self):
+        """
+        Runs the acquisition for 1 second.
+        """
+        self.read_sensor_Ts(1)
+
+    def read_sensor_Ts(self, T):
+        """
+        Runs the acquisition for T seconds (or until threading_event is set).
+        """
+        if self.start_streaming():
+            print("Started reading signal...")
+            self.threading_event.wait(timeout=T)
+            self.stop_streaming()
+            print("Stopped reading signal...")
+        else:
+            print("A problem with sensor or command occured while reading the sensor signal.")
+
+    def start_streaming(self):
+        return self.send_command('start')
+
+    def stop_streaming(self):
+        self.send_command('stop')
+
+    def set_recording(self, recording):
+        self.send_command('set_recording', recording)
+
+    def set_stimulus_frequencies(self, frequencies):
+        self.send_command('set_stimulus_frequencies', list(frequencies))
+
+    def print_sensor_information(self):
+        self.send_command('print_information')
+
+    def get_acquisition_stats(self):
+        """
+        Getter function for the live acquisition counters, kept by the acquisition process.
+
+        :return: dict
+        """
+        return self.send_command('stats')
@@ -0,0 +1,139 @@
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, channels, capacity, dtype=np.float64):
+        """
+        Initialization of a fixed-capacity (channels x capacity) ring buffer.
+        Every sample is stored twice (at idx and idx + capacity), so that the last n <= capacity samples
+        are always available as one contiguous slice of the underlying array, without any copying.
+        """
+        self.channels = channels
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.data = np.zeros((channels, 2 * capacity), dtype=self.dtype)
+        self.count = 0 # Total number of samples written so far (the global index of the next sample)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, sample):
+        """
+        Writes a single sample (one value per channel) into the buffer.
+        """
+        self.extend(np.asarray(sample, dtype=self.dtype).reshape(self.channels, 1))
+
+    def extend(self, block):
+        """
+        Writes a (channels x n) block of samples into the buffer in one go.
+        If n exceeds the capacity, only the last capacity samples are kept.
+        """
+        block = np.asarray(block, dtype=self.dtype)
+        n = block.shape[1]
+        if n == 0:
+            return
+        with self.lock:
+            # The count is only updated once the samples are written (readers in another process rely on it)
+            count = self.count
+            if n > self.capacity:
+                count += n - self.capacity
+                block = block[:, -self.capacity:]
+                n = self.capacity
+
+            start = count % self.capacity
+            first_part = min(n, self.capacity - start)
+            # Both copies of each sample are written, wrapping around the end of the first half if needed
+            self.data[:, start:start + first_part] = block[:, :first_part]
+            self.data[:, start + self.capacity:start + self.capacity + first_part] = block[:, :first_part]
+            if first_part < n:
+                rest = n - first_part
+                self.data[:, :rest] = block[:, first_part:]
+                self.data[:, self.capacity:self.capacity + rest] = block[:, first_part:]
+            self.count = count + n
+
+    def tail(self, n=None):
+        """
+        Returns a (channels x n) view of the last n samples (all the available ones if n is None).
+        The view is not overwritten before another (capacity - n) samples are written into the buffer.
+
+        :return: numpy array view
+        """
+        available = min(self.count, self.capacity)
+        if n is None or n > available:
+            n = available
+        end = self.count % self.capacity + self.capacity
+        return self.data[:, end - n:end]
+
+    def read_since(self, cursor, end=None):
+        """
+        Returns a copy of every sample written after the given cursor (a global sample index), together with the new cursor.
+        Each consumer keeps its own cursor, so that every sample is handed to it exactly once.
+        If the consumer fell behind by more than the capacity, the overwritten samples are skipped.
+        If end is given, only the samples before the global index end are read (e.g. to read the same samples from two buffers).
+
+        :return: (samples (channels x n numpy array), new cursor)
+        """
+        with self.lock:
+            count = self.count if end is None else min(end, self.count)
+            n = max(min(count - cursor, self.capacity - (self.count - count)), 0)
+            stop = count % self.capacity + self.capacity
+            samples = self.data[:, stop - n:stop].copy()
+        return samples, count
+
+
+class SharedRingBuffer(RingBuffer):
+    def __init__(self, channels, capacity, dtype=np.float64, name=None):
+        """
+        Initialization of a ring buffer living in shared memory, so that another process can read it without copying.
+        A new shared memory block is created if name is None, otherwise the named block is attached.
+        There must be a single writing process. The readers rely on the sample count being updated after the samples.
+        """
+        self.channels = channels
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+
+        data_size = channels * 2 * capacity * self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=8 + data_size)
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+        self.name = self.shared_memory.name
+
+        # The sample count (an int64 header) comes first, followed by the samples
+        self.header = np.ndarray((1,), dtype=np.int64, buffer=self.shared_memory.buf)
+        self.data = np.ndarray((channels, 2 * capacity), dtype=self.dtype, buffer=self.shared_memory.buf, offset=8)
+        if self.owner:
+            self.header[0] = 0
+            self.data[:] = 0
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    @count.setter
+    def count(self, value):
+        self.header[0] = value
+
+    def spec(self):
+        """
+        Returns what another process needs to attach this buffer: (channels, capacity, dtype, name).
+        """
+        return (self.channels, self.capacity, self.dtype.str, self.name)
+
+    def close(self):
+        """
+        Detaches the buffer. The owner also frees the shared memory block.
+        """
+        self.header = None
+        self.data = None
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            pass # Views returned by tail() are still alive, the mapping goes away with them
+        if self.owner:
+            self.shared_memory.unlink()
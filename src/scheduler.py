@@ -0,0 +1,125 @@
+import threading
+from time import perf_counter
+
+# Initializations of some static variables:
+FPS = 60
+
+
+class LatestSlot:
+    def __init__(self):
+        """
+        Single-value slot handing the latest result of a producer thread to a consumer thread without locks:
+        every publish replaces a (version, value) tuple, whose rebinding is atomic, so the reader always gets a consistent pair
+        and never waits. Results published between two reads are overwritten (only the latest one matters).
+        """
+        self.latest = (0, None)
+
+    def publish(self, value):
+        version = self.latest[0]
+        self.latest = (version + 1, value)
+
+    def read(self):
+        """
+        :return: (version, value) of the latest published value, version 0 if none was published
+        """
+        return self.latest
+
+    def take_new(self, last_version):
+        """
+        Returns the latest value if it was published after last_version.
+
+        :return: (version, value), value being None if nothing new was published
+        """
+        version, value = self.latest
+        return (version, value) if version > last_version else (last_version, None)
+
+
+class FrameScheduler:
+    def __init__(self, fps=FPS, worker_interval=None):
+        """
+        Initialization of the frame-budget scheduler of the game.
+        The render loop marks its frames with end_frame / begin_frame around clock.tick, and every frame whose work took longer
+        than the frame budget (1 / fps) is counted as an overrun.
+        The signal processing runs on a worker thread, which calls its step every worker_interval seconds (one frame by default)
+        and hands its results to the render loop through the slot, so the render loop never waits on it.
+        A worker step longer than worker_interval is counted as a worker overrun.
+        """
+        self.budget = 1 / fps
+        self.worker_interval = worker_interval or self.budget
+        self.slot = LatestSlot()
+
+        self.frame_start = None
+        self.frames = 0
+        self.frame_overruns = 0
+        self.frame_time = 0.0
+        self.max_frame_time = 0.0
+
+        self.worker_step = None
+        self.worker_thread = None
+        self.stop_event = threading.Event()
+        self.worker_steps = 0
+        self.worker_overruns = 0
+        self.worker_time = 0.0
+        self.max_worker_time = 0.0
+
+    def begin_frame(self):
+        self.frame_start = perf_counter()
+
+    def end_frame(self):
+        """
+        Closes the frame begun by begin_frame (if any) and counts it against the budget.
+        """
+        if self.frame_start is None:
+            return
+        elapsed = perf_counter() - self.frame_start
+        self.frame_start = None
+        self.frames += 1
+        self.frame_time += elapsed
+        self.max_frame_time = max(self.max_frame_time, elapsed)
+        if elapsed > self.budget:
+            self.frame_overruns += 1
+
+    def start_worker(self, step):
+        """
+        Starts calling step() on the worker thread. step returns a result to publish in the slot, or None.
+        """
+        self.worker_step = step
+        self.stop_event.clear()
+        self.worker_thread = threading.Thread(target=self.worker_loop, daemon=True)
+        self.worker_thread.start()
+
+    def stop_worker(self):
+        if self.worker_thread != None:
+            self.stop_event.set()
+            self.worker_thread.join()
+            self.worker_thread = None
+
+    def worker_loop(self):
+        next_step = perf_counter()
+        while not self.stop_event.is_set():
+            start = perf_counter()
+            result = self.worker_step()
+            elapsed = perf_counter() - start
+            if result != None:
+                self.slot.publish(result)
+
+            self.worker_steps += 1
+            self.worker_time += elapsed
+            self.max_worker_time = max(self.max_worker_time, elapsed)
+            if elapsed > self.worker_interval:
+                self.worker_overruns += 1
+
+            # The steps keep their pace, unless the worker fell behind (then it does not try to catch up)
+            next_step = max(next_step + self.worker_interval, perf_counter())
+            self.stop_event.wait(next_step - perf_counter())
+
+    def get_stats(self):
+        """
+        :return: dict of the frame and worker counters: number of frames / steps, overruns, overrun ratio, mean and max durations (in seconds)
+        """
+        return {'frames': self.frames, 'frame_overruns': self.frame_overruns,
+                'frame_overrun_ratio': self.frame_overruns / self.frames if self.frames else 0.0,
+                'mean_frame_time': self.frame_time / self.frames if self.frames else 0.0, 'max_frame_time': self.max_frame_time,
+                'worker_steps': self.worker_steps, 'worker_overruns': self.worker_overruns,
+                'mean_worker_time': self.worker_time / self.worker_steps if self.worker_steps else 0.0,
+                'max_worker_time': self.max_worker_time}
@@ -1,183 +1,326 @@
-from time import sleep
-import concurrent.futures
+from time import sleep, perf_counter
 import threading
-from neurosdk.scanner import Scanner
-# from neurosdk.brainbit_sensor import BrainBitSensor
-# from neurosdk.brainbit_black_sensor import BrainBitBlackSensor
-from neurosdk.cmn_types import *
-from datetime import datetime
+from collections import Counter
+from operator import attrgetter
+import numpy as np
+from ring_buffer import RingBuffer
+from impedance import ResistMonitor
+from sensor_backends import BrainBitBackend
+
+# Initializations of some static variables:
+SAMPLE_FREQ = 250 # Hz, the BrainBit's frequency
+BUFFER_LENGTH = 60 # seconds of signal kept in memory
+CHANNELS = ('O1', 'O2', 'T3', 'T4')
+get_channels = attrgetter(*CHANNELS) # Reads the 4 channel values of one signal packet
+GAP_FILL_POLICIES = (None, 'nan', 'hold', 'linear')
+MAX_GAP_FILL = SAMPLE_FREQ # longer gaps are counted, but not filled
+
+
+def create_buffers(buffer_class, buffer_length=BUFFER_LENGTH, dtype=np.float64):
+    """
+    Allocates the data, timestamp and pack number buffers of a sensor (the pack number is -1 for the filled samples).
+
+    :return: (data buffer, timestamp buffer, packnum buffer)
+    """
+    return (buffer_class(len(CHANNELS), buffer_length * SAMPLE_FREQ, dtype),
+            buffer_class(1, buffer_length * SAMPLE_FREQ),
+            buffer_class(1, buffer_length * SAMPLE_FREQ, np.int64))
 
 
 class Sensor:
-    def __init__(self):
+    def __init__(self, backend=None, buffer_length=BUFFER_LENGTH, dtype=np.float64, gap_fill=None, buffers=None):
         """
         Initialization of the sensor.
+        The data comes from the given backend (a BrainBit headset via bluetooth by default).
+        The 4 channels are stored in a preallocated ring buffer holding the last buffer_length seconds of signal,
+        next to the host timestamp and the SDK pack number of every sample.
+        Samples lost between pack numbers are detected and, depending on gap_fill, replaced by:
+            None - nothing (the gap is only counted),
+            'nan' - NaN samples,
+            'hold' - copies of the last sample before the gap,
+            'linear' - a linear interpolation between the samples around the gap.
+        Already allocated (data, timestamp, packnum) buffers can be given instead (e.g. shared memory ones, see process_sensor.py).
         """
-        self.scanner = None
-        self.sensor = None
-        self.sensorFamily = None
-        self.O1data = []
-        self.O2data = []
-        self.T3data = []
-        self.T4data = []
+        if gap_fill not in GAP_FILL_POLICIES:
+            raise ValueError(f"gap_fill must be one of {GAP_FILL_POLICIES}")
+
+        self.backend = backend if backend != None else BrainBitBackend()
+        if buffers != None:
+            self.data_buffer, self.timestamp_buffer, self.packnum_buffer = buffers
+        else:
+            self.data_buffer, self.timestamp_buffer, self.packnum_buffer = create_buffers(RingBuffer, buffer_length, dtype)
+        self.gap_fill = gap_fill
         self.x_values = []
-        self.resist_data = []
+        self.resist_monitor = ResistMonitor(len(CHANNELS))
         self.threading_event = threading.Event()
-        self.last_packnum = 0
-        self.global_pack_counter = 0
-        self.last_sec = datetime.now().second
-        self.scan_time = 10     # initially: 5
+        self.recording = True # Software gate: while False, the streamed samples are dropped (see acquisition.py)
+        self.listeners = []
+
+        # Acquisition statistics
+        self.packet_count = 0
+        self.packet_sizes = Counter() # Number of packets received for each number of samples per packet
+        self.samples_received = 0
+        self.packs_received = 0
+        self.last_packnum = None
+        self.last_arrival_time = None
+        self.dropped_packs = 0
+        self.gap_count = 0
+        self.filled_samples = 0
+        self.packnum_resets = 0
+        self.gated_samples = 0
 
     def activate_sensor(self):
         """
-        Scans for devices via bluetooth, if a sensor (device) is found then assigns it to a sensor object in a separate thread using ThreadPool.
+        Connects to the backend's data source (for the BrainBit: scans for devices via bluetooth and connects to the first one found).
         """
-        print(f"Scanning for devices for {self.scan_time} sec...")
         try:
-            def sensor_found(scanner, sensors):
-                for index in range(len(sensors)):
-                    print('Sensor found: %s' % sensors[index])
-
-            def on_signal_data_received(sensor, data):
-                self.O1data.append(data[0].O1)
-                self.O2data.append(data[0].O2)
-                self.T3data.append(data[0].T3)
-                self.T4data.append(data[0].T4)
-                
-                # curr_packnum = data[0].PackNum
-                # self.global_pack_counter += 1
-                # curr_sec = datetime.now().second
-                # print(f"curr_sec: {curr_sec}")
-                # if(curr_sec > self.last_sec):
-                #     print(f"Packs spanned: {self.global_pack_counter - self.last_packnum}")
-                #     self.last_packnum = self.global_pack_counter
-                #     self.last_sec = curr_sec
-                #     print("\n")
-
-            def on_resist_data_received(sensor, data):
-                self.resist_data.append(data)
-
-                # print(f"Resist data type: {type(data)}")
-                # print(f"Resist data: {data}")
-
-            # Scanning for devices:
-            self.scanner = Scanner([SensorFamily.LEBrainBit]) # Sensor name may change due to further updates
-
-            self.scanner.sensorsChanged = sensor_found
-            self.scanner.start()
-            sleep(self.scan_time)
-            self.scanner.stop()
-            self.scanner.sensorsChanged = None
-
-            # Getting the sensor information from the found device:
-            sensorsInfo = self.scanner.sensors()
-            current_sensor_info = sensorsInfo[0]
-
-            def device_connection(sensor_info):
-                return self.scanner.create_sensor(sensor_info)
-            
-            # Starting the sensor as a new thread:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(device_connection, current_sensor_info)
-                self.sensor = future.result()
-                print("Device connected")
-            # Defining the sensorFamily:
-            self.sensorFamily = self.sensor.sens_family
-
-            # Assigning the signal data callback function into sensor:
-            if self.sensor.is_supported_feature(SensorFeature.Signal): # FeatureSignal used to be here
-                self.sensor.signalDataReceived = on_signal_data_received
-                # print(f"Value of the signalDataReceived field: {self.sensor.__dict__['signalDataReceived']}")
-
-            # Assigning the resistance value callback function into sensor:
-            if self.sensor.is_supported_feature(SensorFeature.Resist):
-                self.sensor.resistDataReceived = on_resist_data_received
-                # print(f"Value of the resistDataReceived field: {self.sensor.__dict__['resistDataReceived']}")
-                if self.sensor.is_supported_command(SensorCommand.StartResist):
-                    self.sensor.exec_command(SensorCommand.StartResist)
-
+            self.backend.connect(self)
         except Exception as err:
             print(err)
+
+    def on_signal_data_received(self, sensor, data):
+        """
+        Signal callback of the backend, called with a list of signal packets (one sample each).
+        The whole list is copied into the data buffer at once.
+        """
+        arrival_time = perf_counter()
+        if len(data) == 0:
+            return
+        block = np.array(list(map(get_channels, data)), dtype=self.data_buffer.dtype).T
+        packnums = np.fromiter((sample.PackNum for sample in data), dtype=np.int64, count=len(data))
+        if not self.recording:
+            # The pack number and arrival time are still followed, so that the pause is not taken for a gap
+            self.gated_samples += len(data)
+            self.last_packnum = int(packnums[-1])
+            self.last_arrival_time = arrival_time
+            return
+        self.packet_count += 1
+        self.packet_sizes[len(data)] += 1
+        self.samples_received += len(data)
+
+        # Gap detection: consecutive samples share a pack number or follow it
+        packnum_diffs = np.diff(packnums, prepend=packnums[0] if self.last_packnum is None else self.last_packnum)
+        self.packs_received += int(np.count_nonzero(packnum_diffs)) + (self.last_packnum is None)
+        self.packnum_resets += int(np.count_nonzero(packnum_diffs < 0))
+        gaps = np.flatnonzero(packnum_diffs > 1)
+        self.last_packnum = int(packnums[-1])
+
+        if gaps.size:
+            missing_packs = packnum_diffs[gaps] - 1
+            self.gap_count += gaps.size
+            self.dropped_packs += int(missing_packs.sum())
+            if self.gap_fill != None:
+                block, packnums = self.fill_gaps(block, packnums, gaps, missing_packs)
+
+        # The samples of a block are timestamped evenly between the arrival of the previous block and that of this one
+        #   (going back at the sample frequency for the first block), which keeps the timestamps monotonic
+        n = block.shape[1]
+        if self.last_arrival_time is None:
+            timestamps = arrival_time - np.arange(n - 1, -1, -1) / SAMPLE_FREQ
+        else:
+            timestamps = self.last_arrival_time + (arrival_time - self.last_arrival_time) * np.arange(1, n + 1) / n
+        self.last_arrival_time = arrival_time
+
+        # The data buffer is written last, since its sample count tells the readers what is available
+        self.timestamp_buffer.extend(timestamps[None, :])
+        self.packnum_buffer.extend(packnums[None, :])
+        self.data_buffer.extend(block)
+
+        for listener in self.listeners:
+            listener(block, timestamps)
+
+    def fill_gaps(self, block, packnums, gaps, missing_packs):
+        """
+        Inserts the samples lost in each gap (before the sample at the index given in gaps) into the block, following the gap_fill policy.
+
+        :return: (filled block, pack numbers of the filled block)
+        """
+        samples_per_pack = max(1, round(self.samples_received / max(self.packs_received, 1)))
+        previous = self.data_buffer.tail(1)[:, -1] if len(self.data_buffer) else block[:, 0]
+
+        block_parts = []
+        packnum_parts = []
+        start = 0
+        for gap, missing in zip(gaps, missing_packs):
+            if gap > 0:
+                previous = block[:, gap - 1]
+            block_parts.append(block[:, start:gap])
+            packnum_parts.append(packnums[start:gap])
+            start = gap
+
+            n = int(missing) * samples_per_pack
+            if n > MAX_GAP_FILL:
+                continue
+            if self.gap_fill == 'nan':
+                filler = np.full((block.shape[0], n), np.nan)
+            elif self.gap_fill == 'hold':
+                filler = np.repeat(previous[:, None], n, axis=1)
+            else: # 'linear'
+                weights = np.arange(1, n + 1) / (n + 1)
+                filler = previous[:, None] + (block[:, gap] - previous)[:, None] * weights
+            block_parts.append(filler)
+            packnum_parts.append(np.full(n, -1))
+            self.filled_samples += n
+
+        block_parts.append(block[:, start:])
+        packnum_parts.append(packnums[start:])
+        return np.concatenate(block_parts, axis=1), np.concatenate(packnum_parts)
+
+    def add_listener(self, listener):
+        """
+        Registers a listener, called as listener(block, timestamps) with every (4 x n) block of new samples and their timestamps.
+        The listeners run on the acquisition path (in the backend's callback), as soon as the samples arrive, so they must be quick.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def on_resist_data_received(self, sensor, data):
+        """
+        Resistance callback of the backend. The readings go into the bounded rolling resistance monitor.
+        """
+        self.resist_monitor.update(get_channels(data))
+
+        # print(f"Resist data type: {type(data)}")
+        # print(f"Resist data: {data}")
         
     def deactivate_sensor(self):
         """
-        Disconnects from the sensor (device). Terminates the device scanner and the previously constructed sensor object.
+        Disconnects from the sensor (device or other data source).
         """
-        if self.sensor != None:
-            print("Disconnected from sensor")
-            del self.sensor
-        if self.scanner != None:
-            print("Removed scanner")
-            del self.scanner
+        self.backend.disconnect()
+
+    def is_connected(self):
+        return self.backend.is_connected()
 
     def read_sensor_1s(self):
         """
         Runs the callback function for 1 second.
         """
-        if self.sensor.is_supported_command(SensorCommand.StartSignal): # CommandStartSignal was here before
-            self.sensor.exec_command(SensorCommand.StartSignal)
+        if self.backend.start_signal():
             print("Started reading signal...")
             sleep(1)
-            self.sensor.exec_command(SensorCommand.StopSignal) # CommandStopSignal was here before
+            self.backend.stop_signal()
             print("Stopped reading signal...")
         else:
             print("A problem with sensor or command occured during reading sensor.")
-        
-        # if self.sensor.is_supported_command(SensorCommand.StartResist):
-        #     self.sensor.exec_command(SensorCommand.StartResist)
-        #     print("Started reading the resistance...")
-        #     sleep(1)
-        #     self.sensor.exec_command(SensorCommand.StopResist)
-        #     print("Stopped reading the resistance...")
-        # else:
-        #     print("A problem with sensor or command occured while reading sensor resistance.")
 
     def read_sensor_Ts(self, T):
         """
         Runs the callback function for T seconds.
         """
-        if self.sensor.is_supported_command(SensorCommand.StartSignal): # CommandStartSignal was here before
-            self.sensor.exec_command(SensorCommand.StartSignal)
+        if self.backend.start_signal():
             print("Started reading signal...")
             self.threading_event.wait(timeout=T)
-            self.sensor.exec_command(SensorCommand.StopSignal) # CommandStopSignal was here before
+            self.backend.stop_signal()
             print("Stopped reading signal...")
         else:
             print("A problem with sensor or command occured while reading the sensor signal.")
-        
-        # if self.sensor.is_supported_command(SensorCommand.StartResist):
-        #     self.sensor.exec_command(SensorCommand.StartResist)
-        #     print("Started reading the resistance...")
-        #     self.threading_event.wait(timeout=T)
-        #     self.sensor.exec_command(SensorCommand.StopResist)
-        #     print("Stopped reading the resistance...")
-        # else:
-        #     print("A problem with sensor or command occured while reading sensor resistance.")
+
+    def start_streaming(self):
+        """
+        Starts the signal of the backend, without waiting. Returns False if it cannot be started.
+        """
+        return self.backend.start_signal()
+
+    def stop_streaming(self):
+        """
+        Stops the signal of the backend.
+        """
+        self.backend.stop_signal()
+
+    def set_recording(self, recording):
+        """
+        Opens (True) or closes (False) the software gate in front of the buffers.
+        """
+        self.recording = recording
+
+    def set_stimulus_frequencies(self, frequencies):
+        """
+        Passes the flicker frequencies currently shown on to the backend.
+        """
+        self.backend.set_stimulus_frequencies(frequencies)
 
     def print_sensor_information(self):
         """
         Prints the sensor (device) information. (e.g. features, commands, sampling_frequency).
         """
-        print("Sensor Family information:")
-        print(self.sensorFamily)
-        print("Sensor information:")
-        print(self.sensor.features)
-        print(self.sensor.commands)
-        print(self.sensor.parameters)
-        print(self.sensor.name)
-        print(self.sensor.state)
-        print(self.sensor.address)
-        print(self.sensor.serial_number)
-        print(self.sensor.batt_power)
-        print(self.sensor.sampling_frequency)
-        print(self.sensor.gain)
-        print(self.sensor.data_offset)
-        print(self.sensor.version)
-
-    def get_data(self):
+        self.backend.print_information()
+
+    def get_data(self, n=None):
         """
         Getter function for the received data (all 4 channels).
+        Each channel is a view of the last n samples (or of the whole buffer if n is None), so no data is copied.
+
+        :return: data (a 4-tuple of numpy arrays: O1, O2, T3, T4)
+        """
+        return tuple(self.data_buffer.tail(n))
+
+    def get_timestamps(self, n=None):
+        """
+        Getter function for the host timestamps (perf_counter, in seconds) of the last n samples.
+        """
+        return self.timestamp_buffer.tail(n)[0]
+
+    def get_acquisition_stats(self):
+        """
+        Getter function for the live acquisition counters.
+        The effective sample rate is measured over the buffered timestamps of the last (at most) 5 seconds.
+
+        :return: dict
+        """
+        timestamps = self.get_timestamps(5 * SAMPLE_FREQ)
+        if timestamps.size > 1 and timestamps[-1] > timestamps[0]:
+            sample_rate = float((timestamps.size - 1) / (timestamps[-1] - timestamps[0]))
+        else:
+            sample_rate = 0.0
+        return {'samples': self.get_sample_count(),
+                'samples_received': self.samples_received,
+                'packets': self.packet_count,
+                'sample_rate': sample_rate,
+                'gaps': self.gap_count,
+                'dropped_packs': self.dropped_packs,
+                'filled_samples': self.filled_samples,
+                'packnum_resets': self.packnum_resets,
+                'gated_samples': self.gated_samples,
+                'resistance': self.get_resistance(),
+                'contact_quality': self.get_contact_quality()}
+
+    def get_resistance(self):
+        """
+        Getter function for the last resistance (impedance) values received, in Ohm.
+
+        :return: (O1, O2, T3, T4) tuple (None if no resistance was received yet)
+        """
+        resistance = self.resist_monitor.last()
+        return tuple(resistance.tolist()) if resistance is not None else None
+
+    def get_contact_quality(self):
+        """
+        Getter function for the electrode contact quality, from the mean resistance over the last readings.
+
+        :return: (O1, O2, T3, T4) tuple of booleans (True - good contact; all True while no resistance was received)
+        """
+        return tuple(self.resist_monitor.contact_quality().tolist())
+
+    def is_contact_good(self, channels=None):
+        """
+        Returns True if the contact of all the given electrodes (indices, e.g. (0, 1) for O1 and O2; all of them if None) is good.
+        """
+        return self.resist_monitor.is_good(channels)
+
+    def get_sample_count(self):
+        """
+        Getter function for the global index of the next sample, i.e. the number of samples received so far.
+        It only ever increases, so it can be used as a cursor for read_since.
+        """
+        return self.data_buffer.count
+
+    def read_since(self, cursor):
+        """
+        Getter function for the data received after the given cursor (all 4 channels).
 
-        :return: data (a list of 4-tuples)
+        :return: (data (4 x n numpy array: O1, O2, T3, T4), new cursor)
         """
-        return (self.O1data, self.O2data, self.T3data, self.T4data)
\ No newline at end of file
+        return self.data_buffer.read_since(cursor)
@@ -0,0 +1,440 @@
+import os
+import json
+import random
+import threading
+import concurrent.futures
+from time import sleep, perf_counter
+from collections import namedtuple
+import numpy as np
+from synthetic_eeg import SyntheticEEG
+
+# The fields of the BrainBit signal packets, so that every backend can feed the same Sensor callback
+SignalData = namedtuple('SignalData', ['PackNum', 'Marker', 'O1', 'O2', 'T3', 'T4'])
+
+# Where the BrainBit backend remembers the last connected device
+LAST_DEVICE_FILE = "../logs/last_device.json"
+
+# Recording file prefixes (as written by the flicker test) and the channel they hold
+RECORDING_CHANNELS = {'occ_1': 0, 'occ_2': 1, 'tmp_1': 2, 'tmp_2': 3}
+
+
+class SensorBackend:
+    """
+    Interface between a Sensor and the source of its data (a BrainBit headset, a recording, etc.).
+    A backend delivers the signal by calling sensor.on_signal_data_received(backend, packets),
+    where packets is a list of objects with the O1, O2, T3, T4 and PackNum fields.
+    """
+    name = None
+
+    def connect(self, sensor):
+        """
+        Connects to the data source. The signal is delivered to the given sensor.
+        """
+        raise NotImplementedError
+
+    def disconnect(self):
+        """
+        Disconnects from the data source.
+        """
+        raise NotImplementedError
+
+    def is_connected(self):
+        raise NotImplementedError
+
+    def start_signal(self):
+        """
+        Starts delivering the signal. Returns False if it cannot be started.
+
+        :return: boolean
+        """
+        raise NotImplementedError
+
+    def stop_signal(self):
+        """
+        Stops delivering the signal.
+        """
+        raise NotImplementedError
+
+    def set_stimulus_frequencies(self, frequencies):
+        """
+        Tells the backend which flicker frequencies are shown. Only the synthetic backends make use of it.
+        """
+        pass
+
+    def print_information(self):
+        print(f"Backend: {self.name}")
+
+
+def scan_brainbits(scanner, scan_time, count=1):
+    """
+    Scans for BrainBit devices via bluetooth with the given (neurosdk) scanner, until count devices are found
+    (all the devices found in scan_time seconds if count is None), or for at most scan_time seconds.
+
+    :return: list of the found devices' information
+    """
+    from neurosdk.cmn_types import SensorFamily
+
+    print(f"Scanning for devices for at most {scan_time} sec...")
+    found_event = threading.Event()
+
+    def sensor_found(scanner, sensors):
+        for index in range(len(sensors)):
+            print('Sensor found: %s' % sensors[index])
+        found = sum(sensor_info.SensFamily == SensorFamily.LEBrainBit for sensor_info in sensors)
+        if count != None and found >= count:
+            found_event.set()
+
+    scanner.sensorsChanged = sensor_found
+    scanner.start()
+    found_event.wait(timeout=scan_time)
+    scanner.stop()
+    scanner.sensorsChanged = None
+
+    # Getting the sensor information from the found devices:
+    return [sensor_info for sensor_info in scanner.sensors() if sensor_info.SensFamily == SensorFamily.LEBrainBit]
+
+
+def discover_brainbits(scan_time=10, count=None):
+    """
+    Scans for several BrainBit devices at once, to connect each of them with its own BrainBitBackend(sensor_info=...).
+
+    :return: list of the found devices' information
+    """
+    from neurosdk.scanner import Scanner
+    from neurosdk.cmn_types import SensorFamily
+
+    scanner = Scanner([SensorFamily.LEBrainBit])
+    sensorsInfo = scan_brainbits(scanner, scan_time, count)
+    del scanner
+    return sensorsInfo
+
+
+class BrainBitBackend(SensorBackend):
+    name = "BrainBit"
+
+    def __init__(self, scan_time=10, last_device_file=LAST_DEVICE_FILE, sensor_info=None):
+        """
+        Initialization of the BrainBit (bluetooth) backend.
+        scan_time is the longest time (in seconds) the scan waits for a device to appear.
+        If the sensor_info of a device is given (see discover_brainbits), that device is connected directly.
+        """
+        self.scanner = None
+        self.sensor = None
+        self.sensorFamily = None
+        self.scan_time = scan_time     # initially: 5
+        self.last_device_file = last_device_file
+        self.sensor_info = sensor_info
+
+    def load_last_device(self):
+        """
+        Returns the information saved about the last connected device (None if there is none).
+        """
+        try:
+            with open(self.last_device_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_last_device(self, sensor_info):
+        os.makedirs(os.path.dirname(self.last_device_file), exist_ok=True)
+        with open(self.last_device_file, 'w') as f:
+            json.dump({'SensModel': sensor_info.SensModel,
+                       'Name': sensor_info.Name,
+                       'Address': sensor_info.Address,
+                       'SerialNumber': sensor_info.SerialNumber,
+                       'PairingRequired': sensor_info.PairingRequired}, f)
+
+    def scan(self, preferred_address=None):
+        """
+        Scans for devices via bluetooth until a BrainBit is found, or for at most scan_time seconds.
+        If several devices were found, the one with the preferred address is picked.
+
+        :return: the information of the found device (None if no device was found)
+        """
+        sensorsInfo = scan_brainbits(self.scanner, self.scan_time)
+        for sensor_info in sensorsInfo:
+            if sensor_info.Address == preferred_address:
+                return sensor_info
+        return sensorsInfo[0] if sensorsInfo else None
+
+    def connect(self, sensor):
+        """
+        Connects to the last connected device directly, without scanning, if it is available.
+        Otherwise scans for devices via bluetooth, if a sensor (device) is found then assigns it to a sensor object in a separate thread using ThreadPool.
+        """
+        from neurosdk.scanner import Scanner
+        from neurosdk.cmn_types import SensorFamily, SensorFeature, SensorCommand, SensorInfo
+
+        self.scanner = Scanner([SensorFamily.LEBrainBit]) # Sensor name may change due to further updates
+
+        def device_connection(sensor_info):
+            return self.scanner.create_sensor(sensor_info)
+
+        if self.sensor_info != None:
+            # A device picked beforehand (e.g. one of several headsets):
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                self.sensor = executor.submit(device_connection, self.sensor_info).result()
+            print(f"Connected to {self.sensor_info.Name} ({self.sensor_info.Address})")
+            last_device = None
+        else:
+            # Reconnecting to the last device, skipping the discovery:
+            last_device = self.load_last_device()
+        if last_device:
+            try:
+                current_sensor_info = SensorInfo(SensFamily=SensorFamily.LEBrainBit, RSSI=0, **last_device)
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    self.sensor = executor.submit(device_connection, current_sensor_info).result()
+                print(f"Reconnected to {last_device['Name']} ({last_device['Address']})")
+            except Exception as err:
+                print(f"Could not reconnect to the last device: {err}")
+                self.sensor = None
+
+        if self.sensor == None:
+            # Scanning for devices, preferring the last device if it shows up:
+            current_sensor_info = self.scan(last_device['Address'] if last_device else None)
+            if current_sensor_info is None:
+                raise Exception("No BrainBit device found")
+
+            # Starting the sensor as a new thread:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                future = executor.submit(device_connection, current_sensor_info)
+                self.sensor = future.result()
+                print("Device connected")
+            self.save_last_device(current_sensor_info)
+
+        # Defining the sensorFamily:
+        self.sensorFamily = self.sensor.sens_family
+
+        # Assigning the signal data callback function into sensor:
+        if self.sensor.is_supported_feature(SensorFeature.Signal): # FeatureSignal used to be here
+            self.sensor.signalDataReceived = sensor.on_signal_data_received
+
+        # Assigning the resistance value callback function into sensor:
+        if self.sensor.is_supported_feature(SensorFeature.Resist):
+            self.sensor.resistDataReceived = sensor.on_resist_data_received
+            if self.sensor.is_supported_command(SensorCommand.StartResist):
+                self.sensor.exec_command(SensorCommand.StartResist)
+
+    def disconnect(self):
+        """
+        Terminates the device scanner and the previously constructed sensor object.
+        """
+        if self.sensor != None:
+            print("Disconnected from sensor")
+            self.sensor = None
+        if self.scanner != None:
+            print("Removed scanner")
+            self.scanner = None
+
+    def is_connected(self):
+        return self.sensor != None and self.sensor.name == "BrainBit"
+
+    def start_signal(self):
+        from neurosdk.cmn_types import SensorCommand
+
+        if self.sensor.is_supported_command(SensorCommand.StartSignal): # CommandStartSignal was here before
+            self.sensor.exec_command(SensorCommand.StartSignal)
+            return True
+        return False
+
+    def stop_signal(self):
+        from neurosdk.cmn_types import SensorCommand
+
+        self.sensor.exec_command(SensorCommand.StopSignal) # CommandStopSignal was here before
+
+    def print_information(self):
+        """
+        Prints the sensor (device) information. (e.g. features, commands, sampling_frequency).
+        """
+        print("Sensor Family information:")
+        print(self.sensorFamily)
+        print("Sensor information:")
+        print(self.sensor.features)
+        print(self.sensor.commands)
+        print(self.sensor.parameters)
+        print(self.sensor.name)
+        print(self.sensor.state)
+        print(self.sensor.address)
+        print(self.sensor.serial_number)
+        print(self.sensor.batt_power)
+        print(self.sensor.sampling_frequency)
+        print(self.sensor.gain)
+        print(self.sensor.data_offset)
+        print(self.sensor.version)
+
+
+def load_recording(paths):
+    """
+    Loads the *_data.txt recordings of the flicker test (one line of samples per flicker period,
+    the sample frequency on the last line) into one stream per channel.
+    Directories are searched for *_data.txt files. Channels without a recording are left at 0.
+
+    :return: (data (4 x n numpy array: O1, O2, T3, T4), sample_freq)
+    """
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('_data.txt'))
+        else:
+            file_paths.append(path)
+
+    streams = dict()
+    sample_freq = None
+    for file_path in file_paths:
+        channel = RECORDING_CHANNELS.get('_'.join(os.path.basename(file_path).split('_')[:2]))
+        if channel is None or channel in streams:
+            continue
+
+        with open(file_path) as f:
+            split_lines = [line.split() for line in f.readlines()]
+        split_lines = [l for l in split_lines if l]
+
+        if split_lines and len(split_lines[-1]) == 1:
+            sample_freq = float(split_lines[-1][0])
+            split_lines = split_lines[:-1]
+        streams[channel] = np.array([float(e) for l in split_lines for e in l])
+
+    if not streams:
+        raise ValueError(f"No recordings found in {paths}")
+
+    n = min(len(s) for s in streams.values())
+    data = np.zeros((len(RECORDING_CHANNELS), n))
+    for channel, stream in streams.items():
+        data[channel] = stream[:n]
+    return data, sample_freq
+
+
+class StreamingBackend(SensorBackend):
+    def __init__(self, sample_freq, speed=1.0, samples_per_packet=1, packet_loss=0.0):
+        """
+        Base of the backends that produce their signal in software and stream it from a thread through the Sensor callback.
+        speed is the streaming rate relative to real time (None - as fast as possible).
+        packet_loss is the probability of a packet being dropped (its pack numbers are skipped), to simulate a bad bluetooth link.
+        """
+        self.sample_freq = sample_freq
+        self.speed = speed
+        self.samples_per_packet = samples_per_packet
+        self.packet_loss = packet_loss
+
+        self.sensor = None
+        self.pack_num = 0
+        self.stop_event = threading.Event()
+        self.stream_thread = None
+
+    def read_block(self, n):
+        """
+        Returns the next (4 x k) block of samples, k <= n, or None when the stream is over.
+        """
+        raise NotImplementedError
+
+    def connect(self, sensor):
+        self.sensor = sensor
+
+    def disconnect(self):
+        if self.stream_thread != None:
+            self.stop_signal()
+        self.sensor = None
+
+    def is_connected(self):
+        return self.sensor != None
+
+    def start_signal(self):
+        if self.sensor == None:
+            return False
+        if self.stream_thread != None and self.stream_thread.is_alive():
+            return True
+        self.stop_event.clear()
+        self.stream_thread = threading.Thread(target=self.stream, daemon=True)
+        self.stream_thread.start()
+        return True
+
+    def stop_signal(self):
+        self.stop_event.set()
+        if self.stream_thread != None and self.stream_thread is not threading.current_thread():
+            self.stream_thread.join()
+        self.stream_thread = None
+
+    def stream(self):
+        """
+        Streams the signal packet by packet, pacing the packets to the (sped up) sample frequency.
+        """
+        start_time = perf_counter()
+        streamed = 0
+
+        while not self.stop_event.is_set():
+            block = self.read_block(self.samples_per_packet)
+            if block is None:
+                break
+
+            packets = []
+            for i in range(block.shape[1]):
+                packets.append(SignalData(self.pack_num, 0, *block[:, i]))
+                self.pack_num += 1
+            streamed += block.shape[1]
+            if not (self.packet_loss and random.random() < self.packet_loss):
+                self.sensor.on_signal_data_received(self, packets)
+
+            if self.speed:
+                due_time = start_time + streamed / (self.sample_freq * self.speed)
+                delay = due_time - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+
+    def print_information(self):
+        print(f"Backend: {self.name}")
+        print(f"Sample frequency: {self.sample_freq}")
+        print(f"Speed: {self.speed if self.speed else 'unpaced'}")
+
+
+class ReplayBackend(StreamingBackend):
+    name = "Replay"
+
+    def __init__(self, paths, speed=1.0, samples_per_packet=1, loop=False, sample_freq=None, packet_loss=0.0):
+        """
+        Initialization of the replay backend, which streams recorded sessions through the Sensor callback.
+        """
+        self.data, recorded_sample_freq = load_recording(paths)
+        super().__init__(sample_freq or recorded_sample_freq or 250, speed, samples_per_packet, packet_loss)
+        self.loop = loop
+        self.position = 0
+
+    def connect(self, sensor):
+        super().connect(sensor)
+        print(f"Replaying {self.data.shape[1]} samples at {self.sample_freq} Hz")
+
+    def read_block(self, n):
+        if self.position >= self.data.shape[1]:
+            if not self.loop:
+                return None
+            self.position = 0
+
+        block = self.data[:, self.position:self.position + n]
+        self.position += block.shape[1]
+        return block
+
+    def print_information(self):
+        super().print_information()
+        print(f"Samples: {self.data.shape[1]}")
+
+
+class SyntheticBackend(StreamingBackend):
+    name = "Synthetic"
+
+    def __init__(self, speed=1.0, samples_per_packet=1, sample_freq=250, packet_loss=0.0, **generator_options):
+        """
+        Initialization of the synthetic backend, which streams the signal of a SyntheticEEG generator through the Sensor callback.
+        The generator options (noise, drift, blinks, SSVEP, seed, ...) are passed on to SyntheticEEG.
+        """
+        super().__init__(sample_freq, speed, samples_per_packet, packet_loss)
+        self.generator = SyntheticEEG(sample_freq=sample_freq, channels=len(RECORDING_CHANNELS), **generator_options)
+
+    def set_stimulus_frequencies(self, frequencies):
+        self.generator.set_ssvep_frequencies(frequencies)
+
+    def read_block(self, n):
+        return self.generator.generate(n)
+
+    def print_information(self):
+        super().print_information()
+        print(f"SSVEP frequencies: {self.generator.ssvep_freqs}")
+        print(f"Blinks generated: {len(self.generator.blink_onsets)}")
@@ -0,0 +1,120 @@
+import sys
+from time import sleep
+from functools import partial
+from threading import Thread
+from sensor import Sensor
+from process_sensor import ProcessSensor
+from acquisition import AcquisitionService
+from sensor_backends import BrainBitBackend, SyntheticBackend, discover_brainbits
+
+# Initializations of some static variables:
+STATUS_INTERVAL = 1 # seconds between two status prints of the command line session
+
+
+class SensorGroup:
+    def __init__(self, backend_factories, names=None, out_of_process=False, **sensor_options):
+        """
+        Initialization of a group of sensors acquiring concurrently (e.g. several BrainBit headsets in a group session).
+        Every device gets its own Sensor (or ProcessSensor if out_of_process), with its own buffers, and its own AcquisitionService.
+        The devices share no state, so that their callbacks never wait on each other.
+        The sensor options (buffer_length, gap_fill, ...) are passed on to every sensor.
+        """
+        self.names = list(names) if names != None else [f"device_{i + 1}" for i in range(len(backend_factories))]
+        if out_of_process:
+            self.sensors = [ProcessSensor(factory, **sensor_options) for factory in backend_factories]
+        else:
+            self.sensors = [Sensor(factory(), **sensor_options) for factory in backend_factories]
+        self.services = [AcquisitionService(sensor) for sensor in self.sensors]
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def __getitem__(self, index):
+        return self.sensors[index]
+
+    def activate(self):
+        """
+        Connects all the devices in parallel.
+        """
+        threads = [Thread(target=sensor.activate_sensor, daemon=True) for sensor in self.sensors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def deactivate(self):
+        self.stop()
+        for sensor in self.sensors:
+            sensor.deactivate_sensor()
+
+    def start(self):
+        """
+        Starts streaming and recording on every connected device.
+
+        :return: boolean (False if any device could not be started)
+        """
+        return all([service.start() for sensor, service in zip(self.sensors, self.services) if sensor.is_connected()])
+
+    def pause(self):
+        for service in self.services:
+            service.pause()
+
+    def resume(self):
+        for service in self.services:
+            service.resume()
+
+    def stop(self):
+        for service in self.services:
+            service.stop()
+
+    def status(self):
+        """
+        Getter function for the status of every device: connection, recording, effective sample rate, gaps and impedance.
+
+        :return: dict (device name -> status dict)
+        """
+        status = {}
+        for name, sensor, service in zip(self.names, self.sensors, self.services):
+            device_status = {'connected': sensor.is_connected(), 'recording': service.is_recording()}
+            device_status.update(sensor.get_acquisition_stats())
+            status[name] = device_status
+        return status
+
+    def print_status(self):
+        print(f"{'Device':<12}{'Conn.':>6}{'Rec.':>6}{'Rate [Hz]':>11}{'Samples':>10}{'Gaps':>6}{'Dropped':>9}  Resistance (O1, O2, T3, T4) [kOhm]")
+        for name, device_status in self.status().items():
+            resistance = device_status['resistance']
+            resistance = ', '.join(f"{r / 1000:.0f}" for r in resistance) if resistance != None else '-'
+            print(f"{name:<12}{'yes' if device_status['connected'] else 'no':>6}{'yes' if device_status['recording'] else 'no':>6}"
+                  f"{device_status['sample_rate']:>11.1f}{device_status['samples']:>10}{device_status['gaps']:>6}"
+                  f"{device_status['dropped_packs']:>9}  {resistance}")
+
+
+if __name__ == "__main__":
+    # Command format is: python3 ./sensor_group.py [synthetic] <number of devices> <seconds>
+    error_msg = "Command format is: python3 ./sensor_group.py [synthetic] <number of devices> <seconds>"
+    args = sys.argv[1:]
+    synthetic = len(args) > 0 and args[0] == 'synthetic'
+    if synthetic:
+        args = args[1:]
+    if len(args) != 2:
+        sys.exit(error_msg)
+    device_count, duration = int(args[0]), float(args[1])
+
+    if synthetic:
+        factories = [partial(SyntheticBackend, seed=i) for i in range(device_count)]
+        names = None
+    else:
+        sensorsInfo = discover_brainbits(count=device_count)[:device_count]
+        if len(sensorsInfo) < device_count:
+            print(f"Only {len(sensorsInfo)} of the {device_count} devices were found")
+        factories = [partial(BrainBitBackend, sensor_info=sensor_info) for sensor_info in sensorsInfo]
+        names = [sensor_info.Name + ' ' + sensor_info.Address[-5:] for sensor_info in sensorsInfo]
+
+    group = SensorGroup(factories, names, gap_fill='linear')
+    group.activate()
+    group.start()
+    for _ in range(int(duration / STATUS_INTERVAL)):
+        sleep(STATUS_INTERVAL)
+        group.print_status()
+    group.deactivate()
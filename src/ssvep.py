@@ -0,0 +1,178 @@
+from functools import lru_cache
+import numpy as np
+from ring_buffer import RingBuffer
+from dsp import RunningSums
+
+# Initializations of some static variables:
+SAMPLE_FREQ = 250
+SSVEP_WINDOW = SAMPLE_FREQ # samples (1 second, i.e. a 1 Hz resolution)
+HARMONICS = 2
+
+
+@lru_cache(maxsize=None)
+def phasor_steps(omegas, n):
+    """
+    Returns the (read-only) phasors exp(-j * omega * k) for k = 0..n-1, one row per angular frequency (in rad/sample).
+    """
+    steps = np.exp(-1j * np.outer(omegas, np.arange(n)))
+    steps.flags.writeable = False
+    return steps
+
+
+class GoertzelBank:
+    def __init__(self, frequencies, channels=4, sample_freq=SAMPLE_FREQ, harmonics=HARMONICS, window=SSVEP_WINDOW):
+        """
+        Initialization of the streaming SSVEP filter bank. For every channel, it tracks the DFT of the last window samples
+        at each stimulus frequency and its harmonics (what the Goertzel algorithm computes for one block), with O(1) work per sample:
+        every sample is demodulated by the phasor exp(-j * omega * i) of its global index i, and the window sums of the
+        demodulated samples are updated with the entering and leaving samples only.
+        The window mean is removed, so that the electrode offset does not leak into the bins.
+        The power is only meaningful once window samples were received (the window starts zero filled).
+        """
+        self.frequencies = list(frequencies)
+        self.channels = channels
+        self.sample_freq = sample_freq
+        self.harmonics = harmonics
+        self.window = window
+        self.bins = np.array([f * h for f in self.frequencies for h in range(1, harmonics + 1)], dtype=float)
+        self.omegas = tuple(2 * np.pi * self.bins / sample_freq)
+        omegas = np.array(self.omegas)
+        self.window_phase = np.exp(1j * omegas * window) # Turns the phasor of a sample into the one of the sample window samples before it
+        self.phase_step = np.exp(-1j * omegas)
+        self.running_sums = RunningSums(window, self.refresh)
+        self.reset()
+
+    def reset(self):
+        """
+        Zero fills the window again (the power is meaningful once window new samples were received).
+        """
+        self.history = RingBuffer(self.channels, self.window)
+        self.history.extend(np.zeros((self.channels, self.window)))
+        self.phase = np.ones(len(self.bins), dtype=complex) # Phasor of the next sample
+        self.sum_demodulated = np.zeros((self.channels, len(self.bins)), dtype=complex)
+        self.sum_phasor = np.zeros(len(self.bins), dtype=complex)
+        self.sum_x = np.zeros(self.channels)
+        self.bin_power = np.zeros((self.channels, len(self.bins)))
+        self.running_sums.reset()
+
+    def update(self, block):
+        """
+        Adds a (channels x n) block of samples.
+
+        :return: (channels x frequencies x n numpy array) SSVEP power (summed over the harmonics) after each new sample
+        """
+        block = np.asarray(block, dtype=np.float64)
+        power = np.empty((self.channels, len(self.frequencies), block.shape[1]))
+        start = 0
+        while start < block.shape[1]:
+            step = min(block.shape[1] - start, self.window)
+            power[:, :, start:start + step] = self.slide(block[:, start:start + step])
+            start += step
+        return power
+
+    def slide(self, block):
+        """
+        Adds a block of at most window samples, each sample pushing the oldest one out of the window.
+        """
+        n = block.shape[1]
+        leaving = self.history.tail()[:, :n]
+        phasors = self.phase[:, None] * phasor_steps(self.omegas, n) # bins x n
+        leaving_phasors = phasors * self.window_phase[:, None]
+
+        sum_demodulated = self.sum_demodulated[:, :, None] + np.cumsum(block[:, None, :] * phasors - leaving[:, None, :] * leaving_phasors, axis=2)
+        sum_phasor = self.sum_phasor[:, None] + np.cumsum(phasors - leaving_phasors, axis=1)
+        sum_x = self.sum_x[:, None] + np.cumsum(block - leaving, axis=1)
+
+        # DFT of the window minus its mean, at every bin and after every sample
+        spectrum = sum_demodulated - (sum_x / self.window)[:, None, :] * sum_phasor[None, :, :]
+        bin_power = 2 * np.abs(spectrum) ** 2 / self.window ** 2 # Mean square of the sinusoid at each bin
+
+        self.sum_demodulated, self.sum_phasor, self.sum_x = sum_demodulated[:, :, -1], sum_phasor[:, -1], sum_x[:, -1]
+        self.phase = phasors[:, -1] * self.phase_step
+        self.phase /= np.abs(self.phase)
+        self.history.extend(block)
+        self.bin_power = bin_power[:, :, -1]
+        self.running_sums.advance(n)
+
+        return bin_power.reshape(self.channels, len(self.frequencies), self.harmonics, n).sum(axis=2)
+
+    def refresh(self):
+        """
+        Recomputes the window sums from the samples in the window.
+        """
+        window_phasors = self.phase[:, None] * np.conj(phasor_steps(self.omegas, self.window + 1)[:, :0:-1])
+        samples = self.history.tail()
+        self.sum_demodulated = samples @ window_phasors.T
+        self.sum_phasor = window_phasors.sum(axis=1)
+        self.sum_x = samples.sum(axis=1)
+
+    def ssvep_power(self):
+        """
+        :return: (channels x frequencies numpy array) current SSVEP power at each stimulus frequency (summed over the harmonics)
+        """
+        return self.bin_power.reshape(self.channels, len(self.frequencies), self.harmonics).sum(axis=2)
+
+
+@lru_cache(maxsize=64)
+def reference_basis(frequency, n, sample_freq, harmonics):
+    """
+    Returns the (read-only, n x 2 * harmonics) orthonormal basis (Q of the QR decomposition) of the centered
+    sine/cosine reference signals of a stimulus frequency and its harmonics, over a window of n samples.
+    """
+    t = np.arange(n) / sample_freq
+    references = np.column_stack([wave(2 * np.pi * h * frequency * t) for h in range(1, harmonics + 1) for wave in (np.sin, np.cos)])
+    references -= references.mean(axis=0)
+    basis = np.linalg.qr(references)[0]
+    basis.flags.writeable = False
+    return basis
+
+
+@lru_cache(maxsize=16)
+def reference_bases(frequencies, n, sample_freq, harmonics):
+    """
+    Returns the reference bases of all the stimulus frequencies, stacked into a (read-only, frequencies x n x 2 * harmonics) array.
+    """
+    bases = np.stack([reference_basis(f, n, sample_freq, harmonics) for f in frequencies])
+    bases.flags.writeable = False
+    return bases
+
+
+class CCAClassifier:
+    def __init__(self, frequencies, sample_freq=SAMPLE_FREQ, harmonics=HARMONICS, threshold=0.3):
+        """
+        Initialization of the canonical correlation analysis (CCA) SSVEP classifier.
+        A (channels x n) window is scored against the sine/cosine references of every stimulus frequency:
+        the score is the largest canonical correlation between the channels and the references, i.e. the largest
+        singular value of Qx^T Qy, Qx and Qy being orthonormal bases of the centered channels and references.
+        The reference bases are cached per frequency, window length and sample frequency, so a decision only costs
+        the QR decomposition of the window and one small SVD per frequency.
+        The window is classified as the best scoring frequency, unless no score reaches the threshold.
+        """
+        self.frequencies = tuple(frequencies)
+        self.sample_freq = sample_freq
+        self.harmonics = harmonics
+        self.threshold = threshold
+
+    def scores(self, data):
+        """
+        :return: numpy array of the canonical correlation of the window with each stimulus frequency
+        """
+        data = np.asarray(data, dtype=np.float64)
+        n = data.shape[1]
+        channels_basis = np.linalg.qr((data - data.mean(axis=1, keepdims=True)).T)[0] # n x channels
+        bases = reference_bases(self.frequencies, n, self.sample_freq, self.harmonics)
+        return np.linalg.svd(channels_basis.T @ bases, compute_uv=False)[:, 0]
+
+    def classify(self, data):
+        """
+        Classifies a (channels x n) window.
+
+        :return: (the detected stimulus frequency (None if indeterminate), scores)
+        """
+        if not np.isfinite(data).all():
+            return None, np.zeros(len(self.frequencies))
+        scores = self.scores(data)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None, scores
+        return self.frequencies[best], scores
@@ -0,0 +1,70 @@
+from collections import namedtuple
+import numpy as np
+from dsp import exact_bin_segment
+
+# Initializations of some static variables:
+MAX_TABLE_SECS = 60 # The tables cover at most this long (they wrap around after it)
+WAVEFORMS = ('square', 'sine')
+
+# Flicker target: frequency (Hz), waveform ('square' or 'sine'), phase (in cycles, at frame 0)
+#   and duty (the part of a square cycle spent at the background luminance)
+StimulusTarget = namedtuple('StimulusTarget', ['frequency', 'waveform', 'phase', 'duty'], defaults=['square', 0.0, 0.5])
+
+
+class StimulusSchedule:
+    def __init__(self, refresh_rate, targets, background=(255, 255, 255), pulse=(0, 0, 0)):
+        """
+        Initialization of the stimulus schedule of N flicker targets (name -> StimulusTarget).
+        The luminance of every target at every frame (0 - background colour, 1 - pulse colour) is precomputed once,
+        sampling the waveform at the frame times, so any frequency can be shown, including the ones that do not divide
+        the refresh rate (sampled sinusoid), with any phase offset. The colours of the frames are precomputed too,
+        so a frame only costs one table lookup per target.
+        The tables cover the shortest number of frames holding a whole number of cycles of every target (at most MAX_TABLE_SECS),
+        so that they wrap around without a phase jump.
+        """
+        self.refresh_rate = refresh_rate
+        self.names = list(targets)
+        self.targets = [targets[name] for name in self.names]
+        for target in self.targets:
+            if target.waveform not in WAVEFORMS:
+                raise ValueError(f"Unknown waveform: {target.waveform}")
+
+        frequencies = [target.frequency for target in self.targets]
+        max_frames = int(round(MAX_TABLE_SECS * refresh_rate))
+        self.length = exact_bin_segment(frequencies, refresh_rate, 1, max_frames)
+        cycles = np.array(frequencies) * self.length / refresh_rate
+        if not np.allclose(cycles, np.round(cycles)):
+            # No whole number of cycles of every target fits in the tables
+            self.length = max_frames
+
+        self.luminance = self.luminance_table(np.arange(self.length)) # targets x frames
+        background, pulse = np.array(background, dtype=float), np.array(pulse, dtype=float)
+        colors = np.round(background + self.luminance[:, :, None] * (pulse - background)).astype(int)
+        self.colors = [[tuple(color) for color in target_colors.tolist()] for target_colors in colors]
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def luminance_table(self, frames):
+        """
+        :return: (targets x frames numpy array) luminance of every target at the given frame indices
+        """
+        frequencies = np.array([target.frequency for target in self.targets], dtype=float)[:, None]
+        phases = np.array([target.phase for target in self.targets], dtype=float)[:, None]
+        cycles = frames[None, :] * frequencies / self.refresh_rate + phases
+        position = np.round(cycles, 9) % 1 # Position of every frame in its cycle (rounded so that whole cycles stay whole)
+
+        table = np.empty(position.shape)
+        for i, target in enumerate(self.targets):
+            if target.waveform == 'square':
+                table[i] = position[i] >= round(target.duty, 9)
+            else:
+                table[i] = 0.5 - 0.5 * np.cos(2 * np.pi * position[i])
+        return table
+
+    def get_luminance(self, name, frame):
+        return self.luminance[self.index[name], frame % self.length]
+
+    def get_color(self, name, frame):
+        """
+        :return: (r, g, b) colour of a target at a frame
+        """
+        return self.colors[self.index[name]][frame % self.length]
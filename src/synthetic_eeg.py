@@ -0,0 +1,106 @@
+import numpy as np
+
+# Initializations of some static variables (amplitudes in V, roughly matching the recorded BrainBit sessions):
+BASELINE = 0.0288
+NOISE_AMPLITUDE = 1 * (10 ** -5)
+DRIFT_AMPLITUDE = 2 * (10 ** -6) # per sqrt(second)
+BLINK_AMPLITUDE = 2 * (10 ** -4)
+BLINK_DURATION = 0.3 # seconds
+SSVEP_AMPLITUDE = 2 * (10 ** -6)
+NOISE_CHUNK = 4096 # samples of 1/f noise generated at once
+
+
+class SyntheticEEG:
+    def __init__(self, sample_freq=250, channels=4, ssvep_freqs=(), ssvep_amplitude=SSVEP_AMPLITUDE, harmonics=2,
+                       ssvep_channel_weights=(1, 1, 0.3, 0.3), blink_channels=(0, 1), blink_rate=0.2,
+                       blink_amplitude=BLINK_AMPLITUDE, noise_amplitude=NOISE_AMPLITUDE,
+                       drift_amplitude=DRIFT_AMPLITUDE, baseline=BASELINE, seed=None):
+        """
+        Initialization of the synthetic EEG generator. It produces (channels x n) blocks made of:
+            - a baseline offset plus a random-walk electrode drift,
+            - 1/f (pink) noise,
+            - blink transients (negative deflections) on the blink channels (O1/O2), at blink_rate blinks per second,
+            - SSVEP responses at the stimulus frequencies (and their harmonics), weighted per channel.
+        Everything is generated in vectorized blocks, so it runs many times faster than real time.
+        The onsets of the generated blinks are kept as ground truth in blink_onsets.
+        """
+        self.sample_freq = sample_freq
+        self.channels = channels
+        self.ssvep_amplitude = ssvep_amplitude
+        self.harmonics = harmonics
+        self.ssvep_channel_weights = np.resize(np.asarray(ssvep_channel_weights, dtype=float), channels)
+        self.blink_channels = [c for c in blink_channels if c < channels]
+        self.blink_rate = blink_rate
+        self.blink_amplitude = blink_amplitude
+        self.noise_amplitude = noise_amplitude
+        self.drift_amplitude = drift_amplitude
+        self.rng = np.random.default_rng(seed)
+        self.set_ssvep_frequencies(ssvep_freqs)
+
+        self.position = 0 # Global index of the next generated sample
+        self.blink_onsets = []
+        self.drift = np.full(channels, float(baseline))
+        self.noise = np.empty((channels, 0))
+
+        # Blink template: a half-sine dip, and the part of the blinks spilling over into the next block
+        blink_len = max(1, int(BLINK_DURATION * sample_freq))
+        self.blink_template = -np.sin(np.pi * np.arange(blink_len) / blink_len)
+        self.blink_spill = np.zeros((channels, blink_len))
+
+    def set_ssvep_frequencies(self, ssvep_freqs):
+        """
+        Sets the stimulus frequencies the SSVEP responses are generated at.
+        """
+        self.ssvep_freqs = [f for f in ssvep_freqs if f]
+
+    def pink_noise(self, n):
+        """
+        Returns (channels x n) unit-variance 1/f noise, shaped in the frequency domain chunk by chunk.
+        """
+        while self.noise.shape[1] < n:
+            spectrum = np.fft.rfft(self.rng.standard_normal((self.channels, NOISE_CHUNK)), axis=1)
+            freqs = np.fft.rfftfreq(NOISE_CHUNK)
+            freqs[0] = freqs[1]
+            chunk = np.fft.irfft(spectrum / np.sqrt(freqs), n=NOISE_CHUNK, axis=1)
+            chunk /= chunk.std(axis=1, keepdims=True)
+            self.noise = np.concatenate((self.noise, chunk), axis=1)
+
+        noise, self.noise = self.noise[:, :n], self.noise[:, n:]
+        return noise
+
+    def generate(self, n):
+        """
+        Generates the next n samples of every channel.
+
+        :return: data (channels x n numpy array)
+        """
+        t = (self.position + np.arange(n)) / self.sample_freq
+
+        # Drift and noise
+        steps = self.rng.standard_normal((self.channels, n)) * (self.drift_amplitude / np.sqrt(self.sample_freq))
+        drift = self.drift[:, None] + np.cumsum(steps, axis=1)
+        self.drift = drift[:, -1]
+        data = drift + self.noise_amplitude * self.pink_noise(n)
+
+        # SSVEP responses
+        if self.ssvep_freqs:
+            ssvep = np.zeros(n)
+            for f in self.ssvep_freqs:
+                for h in range(1, self.harmonics + 1):
+                    ssvep += np.sin(2 * np.pi * f * h * t) / h
+            data += self.ssvep_amplitude * self.ssvep_channel_weights[:, None] * ssvep
+
+        # Blinks
+        blink_len = self.blink_template.size
+        blinks = np.zeros((self.channels, n + blink_len))
+        blinks[:, :blink_len] = self.blink_spill
+        if self.blink_channels:
+            onsets = np.flatnonzero(self.rng.random(n) < self.blink_rate / self.sample_freq)
+            for onset in onsets:
+                blinks[self.blink_channels, onset:onset + blink_len] += self.blink_amplitude * self.blink_template
+            self.blink_onsets += (self.position + onsets).tolist()
+        data += blinks[:, :n]
+        self.blink_spill = blinks[:, n:]
+
+        self.position += n
+        return data